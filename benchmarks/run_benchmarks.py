@@ -0,0 +1,244 @@
+''' Benchmarks of the pipeline stages on synthetic cohorts.
+
+Each stage is run on a cohort generated for every combination of node counts, animals per
+group and NaN rates, in a temporary directory. The wall and CPU times of each repeat and the
+peak memory allocated by one more (traced) run are written to a JSON file of
+benchmarks/results/, named after the date and the commit, to be compared across commits:
+
+    python benchmarks/run_benchmarks.py --nodes 26 100 400
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/a.json benchmarks/results/b.json
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import traceback
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from benchmarks.synthetic import make_cohort
+from utils.preproc import (check_tree, txt_csv, zscore_mat, all_df, build_file_index, get_cohort,
+                           get_grp_mat, get_av_grp_mat, get_nbs_inputs)
+from utils.conn import ttest_with_fdr, permutation_test_with_fdr, nbs_bct_corr_z, get_components
+from utils.plotting import plot_mat
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+def stages(n_permutations=1000, nbs_k=100, nbs_thresh=0.15):
+    ''' The benchmarked stages, in the order of the pipeline, as (name, setup, run). setup is
+    not timed, it returns the arguments of run. They are run in the directory of the cohort.'''
+
+    def load_setup():
+        # the cohort is loaded from the .csv files of the index
+        build_file_index()
+        return ()
+
+    def nbs_setup():
+        stack, y_vec, _, _ = get_nbs_inputs('WT', '3xTgAD')
+        return stack, y_vec
+
+    def components_setup():
+        # edges of the average z-scored matrix above its 90th percentile
+        mat = get_av_grp_mat('WT')
+        tril = mat[np.tril_indices(len(mat), k=-1)]
+        adj = (mat > np.percentile(tril, 90)).astype(float)
+        np.fill_diagonal(adj, 0)
+        return (adj,)
+
+    def plot_setup():
+        return get_av_grp_mat('WT'), 'WT'
+
+    def grp_mat():
+        # from a reloaded cohort: on the cached one, get_grp_mat only builds views
+        get_cohort(reload=True)
+        return get_grp_mat('WT')
+
+    def plot(data, title):
+        # the figure is only drawn when it is saved
+        plot_mat(data, title).savefig(io.BytesIO(), format='png')
+
+    return [
+        ('txt_csv', tuple, txt_csv),
+        ('zscore_mat', tuple, zscore_mat),
+        ('all_df', tuple, all_df),
+        ('load_cohort', load_setup, lambda: get_cohort(reload=True)),
+        ('get_grp_mat', load_setup, grp_mat),
+        ('ttest_with_fdr', tuple, lambda: ttest_with_fdr('WT', '3xTgAD')),
+        ('permutation_test_with_fdr', tuple,
+         lambda: permutation_test_with_fdr('WT', '3xTgAD', n_permutations=n_permutations, seed=0)),
+        ('nbs_bct_corr_z', nbs_setup,
+         lambda stack, y_vec: nbs_bct_corr_z(stack, nbs_thresh, y_vec, k=nbs_k, seed=0)),
+        ('get_components', components_setup, get_components),
+        ('plot_mat', plot_setup, plot),
+    ]
+
+def measure(setup, run, repeat=3, memory=True):
+    ''' Times repeat calls of run(*setup()), then traces the peak memory of one more call.
+    The output of the stage is discarded.
+
+    Returns
+    -------
+    result : dict
+        The wall and CPU times of each repeat (s), the best and median wall times, the peak
+        memory allocated during the call (MB, None if memory is False) and the status ('ok',
+        or 'error' with the error message if the stage raised).
+    '''
+
+    result = {'status': 'ok', 'wall_s': [], 'cpu_s': []}
+    try:
+        with redirect_stdout(io.StringIO()):
+            args = setup()
+            for _ in range(repeat):
+                wall, cpu = time.perf_counter(), time.process_time()
+                run(*args)
+                result['wall_s'].append(time.perf_counter() - wall)
+                result['cpu_s'].append(time.process_time() - cpu)
+            result['peak_mb'] = None
+            if memory:
+                tracemalloc.start()
+                try:
+                    run(*args)
+                    result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                finally:
+                    tracemalloc.stop()
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['traceback'] = traceback.format_exc(limit=-3)
+    if result['wall_s']:
+        result['best_s'] = min(result['wall_s'])
+        result['median_s'] = float(np.median(result['wall_s']))
+
+    return result
+
+def run_config(n_nodes, n_per_group, nan_rate, repeat=3, memory=True, only=None, **stage_params):
+    ''' Benchmarks the stages on one synthetic cohort, in a temporary directory'''
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='mconn_bench_')
+    config = {'n_nodes': n_nodes, 'n_per_group': n_per_group, 'nan_rate': nan_rate, 'stages': {}}
+    try:
+        make_cohort(workdir, n_nodes=n_nodes, n_per_group=n_per_group, nan_rate=nan_rate)
+        os.chdir(workdir)
+        with redirect_stdout(io.StringIO()):
+            check_tree()
+        for name, setup, run in stages(**stage_params):
+            if only and name not in only:
+                continue
+            result = measure(setup, run, repeat=repeat, memory=memory)
+            config['stages'][name] = result
+            if result['status'] == 'ok':
+                print(f'  {name:<28} {result["best_s"]:9.4f} s  '
+                      f'{result["peak_mb"] if result["peak_mb"] is not None else float("nan"):9.1f} MB')
+            else:
+                print(f'  {name:<28} failed: {result["error"]}')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return config
+
+def git_commit():
+    ''' Hash of the current commit and whether the tree has uncommitted changes'''
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, bool(status)
+
+def compare(old_path, new_path):
+    ''' Prints the ratio of the best times of the stages of two results files (new / old)'''
+
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_configs = {(c['n_nodes'], c['n_per_group'], c['nan_rate']): c for c in old['configs']}
+
+    print(f'old: {old.get("commit")} ({old.get("date")})')
+    print(f'new: {new.get("commit")} ({new.get("date")})')
+    for config in new['configs']:
+        key = (config['n_nodes'], config['n_per_group'], config['nan_rate'])
+        print('nodes=%i animals/group=%i nan_rate=%g' % key)
+        old_stages = old_configs.get(key, {}).get('stages', {})
+        for name, result in config['stages'].items():
+            before = old_stages.get(name, {}).get('best_s')
+            after = result.get('best_s')
+            if before is None or after is None:
+                print(f'  {name:<28} {"-":>9}')
+                continue
+            print(f'  {name:<28} {before:9.4f} s -> {after:9.4f} s  x{after / before:.2f}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic cohorts')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[26, 100],
+                        help='node counts of the synthetic atlases')
+    parser.add_argument('--animals', type=int, nargs='+', default=[8], help='animals per group')
+    parser.add_argument('--nan-rates', type=float, nargs='+', default=[0.01],
+                        help='fractions of NaN edges in each matrix')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each stage')
+    parser.add_argument('--n-permutations', type=int, default=1000)
+    parser.add_argument('--nbs-k', type=int, default=100)
+    parser.add_argument('--stages', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run')
+    parser.add_argument('--out', default=None, help='results file, default benchmarks/results/<date>_<commit>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files instead of running the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return None
+
+    commit, dirty = git_commit()
+    date = datetime.now()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': date.isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': {'repeat': args.repeat, 'n_permutations': args.n_permutations, 'nbs_k': args.nbs_k},
+        'configs': [],
+    }
+    for n_nodes in args.nodes:
+        for n_per_group in args.animals:
+            for nan_rate in args.nan_rates:
+                print(f'nodes={n_nodes} animals/group={n_per_group} nan_rate={nan_rate}')
+                results['configs'].append(run_config(n_nodes, n_per_group, nan_rate, repeat=args.repeat,
+                                                     memory=not args.no_memory, only=args.stages,
+                                                     n_permutations=args.n_permutations,
+                                                     nbs_k=args.nbs_k))
+
+    fout = args.out
+    if fout is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        fout = os.path.join(RESULTS_DIR, f'{date:%Y%m%d-%H%M%S}_{(commit or "nogit")[:8]}'
+                                         f'{"-dirty" if dirty else ""}.json')
+    with open(fout, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'Results written to {fout}')
+
+    return None
+
+if __name__ == '__main__':
+    main()
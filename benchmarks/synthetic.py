@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pandas as pd
+from utils.params import acronyms
+from utils.preproc import GROUP_NAMES
+from utils.edges import n_edges, vec2mat
+
+def node_labels(n_nodes):
+    ''' ROI labels of a synthetic atlas: the acronyms of the real one if it has the same size'''
+
+    if n_nodes == len(acronyms):
+        return list(acronyms)
+    return [f'ROI{i:03d}-{"L" if i % 2 == 0 else "R"}' for i in range(n_nodes)]
+
+def synthetic_mat(n_nodes, rng, shift=None, nan_rate=0.0):
+    ''' A random symmetric connectivity matrix with ones on the diagonal
+
+    Parameters
+    ----------
+    n_nodes : int
+        The number of nodes (ROIs)
+    rng : np.random.Generator
+        The random generator
+    shift : np.ndarray | None
+        Effect of the group, added to the lower triangle values before the tanh
+    nan_rate : float
+        Fraction of the edges set to NaN (both halves of the matrix), as for the ROIs that
+        are missing in some of the real acquisitions
+
+    Returns
+    -------
+    mat : np.ndarray
+        The matrix, shape (n_nodes, n_nodes)
+    '''
+
+    values = rng.normal(0.3, 0.3, size=n_edges(n_nodes))
+    if shift is not None:
+        values += shift
+    if nan_rate > 0:
+        values[rng.random(len(values)) < nan_rate] = np.nan
+
+    return vec2mat(np.tanh(values))
+
+def make_cohort(root, n_nodes=26, n_per_group=8, nan_rate=0.0, effect=0.3, seed=0):
+    ''' Writes a synthetic cohort in the layout expected by pre_run_check: one .txt matrix
+    per animal in data/<group>/ and the description of the animals in data/code_animaux.xlsx.
+    Half of the animals of each group are females.
+
+    Every group but the first one has an effect on a random tenth of the edges, so that the
+    statistical tests and the NBS find something.
+
+    Parameters
+    ----------
+    root : str
+        Directory where data/ is created
+    n_nodes : int
+        The number of nodes (ROIs) of the matrices
+    n_per_group : int
+        The number of animals in each group
+    nan_rate : float
+        Fraction of the edges of each matrix set to NaN
+    effect : float
+        Size of the group effects
+    seed : int
+        Seed of the random generator
+
+    Returns
+    -------
+    desc : pd.DataFrame
+        The description of the animals, as written to code_animaux.xlsx
+    '''
+
+    rng = np.random.default_rng(seed)
+    labels = node_labels(n_nodes)
+    rows = []
+    animal_id = 100
+    for i, (name, pop) in enumerate(GROUP_NAMES.items()):
+        os.makedirs(os.path.join(root, 'data', pop), exist_ok=True)
+        shift = np.zeros((n_edges(n_nodes),))
+        if i > 0:
+            shift[rng.random(len(shift)) < 0.1] = effect * rng.choice([-1, 1])
+        for a in range(n_per_group):
+            animal_id += 1
+            mat = synthetic_mat(n_nodes, rng, shift=shift, nan_rate=nan_rate)
+            fname = os.path.join(root, 'data', pop, f'Souris_{animal_id}_conn.txt')
+            pd.DataFrame(mat, index=labels, columns=labels).to_csv(fname, sep=';')
+            rows.append((name, 'f' if a % 2 == 0 else 'm', animal_id))
+
+    desc = pd.DataFrame(rows, columns=['Groupe', 'Sexe', 'ID'])
+    desc.to_excel(os.path.join(root, 'data', 'code_animaux.xlsx'), index=False)
+
+    return desc
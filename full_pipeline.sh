@@ -1,6 +1,6 @@
 #!/bin/bash
 
-# This script runs the Python scripts plot_av.py and stats.py
+# This script runs the analysis (plot_individuals.py, plot_av.py and stats.py) with pipeline.py
 
 check_environment() {
     if [[ "$(hostname)" == "MacBook-Pro-de-Nisso-6.local" ]]; then
@@ -17,25 +17,13 @@ check_environment() {
 # Activate the appropriate Conda environment
 check_environment
 
-# Run the Python scripts and the bash script
-echo "Running plot_individuals.py.py..."
-python3 plot_individuals.py
+# Run the analysis: plot_individuals.py, plot_av.py and stats.py as the stages of
+# pipeline.py, the independent ones at the same time. Extra arguments are passed to
+# pipeline.py (e.g. ./full_pipeline.sh --cpus 4).
+echo "Running pipeline.py..."
+python3 pipeline.py "$@"
 if [ $? -ne 0 ]; then
-    echo "Error: plot_individuals.py failed."
-    exit 1
-fi
-
-echo "Running plot_av.py..."
-python3 plot_av.py
-if [ $? -ne 0 ]; then
-    echo "Error: plot_av.py failed."
-    exit 1
-fi
-
-echo "Running stats.py..."
-python3 stats.py
-if [ $? -ne 0 ]; then
-    echo "Error: stats.py failed."
+    echo "Error: pipeline.py failed."
     exit 1
 fi
 
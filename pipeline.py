@@ -0,0 +1,98 @@
+import argparse
+from utils.preproc import pre_run_check, get_cohort
+from utils.params import (groups, comparisons, n_jobs, pipeline_cpus, seed, stop_hits, perm_statistic,
+                          perm_correction, nbs_thresh, nbs_k, nbs_extent, nbs_sweep_threshs)
+from utils.pipeline import Stage, run_stages
+from utils.trace import start_trace
+from plot_individuals import plot_individuals
+from plot_av import plot_boxplots, plot_group_mats
+from stats import run_all_anova, run_all_ttest, run_all_permutations, run_all_nbs
+
+################################################################################
+# Runs the whole analysis (plot_individuals.py, plot_av.py and stats.py) as
+# stages with dependencies. The data is preprocessed and the cohort loaded once,
+# then the independent stages run at the same time within the CPU budget
+# (pipeline_cpus in utils/params.py). Stages whose inputs, parameters and outputs
+# did not change since their last run are skipped.
+#
+#   python pipeline.py                  # all the stages
+#   python pipeline.py nbs ttest        # only these stages (and what they need)
+#   python pipeline.py --cpus 4 --force # 4 CPUs, run even the up to date stages
+################################################################################
+
+COHORT_FILES = ['data/all_df.csv', 'data/cohort.npy', 'data/cohort_index.csv']
+
+def plot_averages(n_jobs=n_jobs):
+    ''' The figures of plot_av.py'''
+
+    plot_boxplots()
+    plot_group_mats(n_jobs=n_jobs)
+
+def load_cohort():
+    ''' Loads the cohort once, the stages forked afterwards share it (the spawned ones reopen
+    the memory-mapped store)'''
+
+    get_cohort(reload=True)
+
+def pipeline_stages(cpus=pipeline_cpus):
+    ''' The stages of the analysis, the longest first so that they get the CPUs first'''
+
+    design = {'groups': groups, 'comparisons': comparisons}
+
+    return [
+        # ingestion, z-scoring and summary dataframe: pre_run_check is incremental and parses
+        # each new .txt file once for the three of them
+        Stage('preprocess', lambda: pre_run_check(n_jobs=cpus), in_process=True),
+        Stage('cohort', load_cohort, deps=['preprocess'], in_process=True),
+        Stage('nbs', run_all_nbs, deps=['cohort'], inputs=COHORT_FILES, outputs=['derivative/nbs'],
+              params=dict(design, seed=seed, stop_hits=stop_hits, thresh=nbs_thresh, k=nbs_k, extent=nbs_extent,
+                          sweep_threshs=nbs_sweep_threshs), parallel=True),
+        Stage('permutations', run_all_permutations, deps=['cohort'], inputs=COHORT_FILES,
+              outputs=['derivative/permutations'],
+              params=dict(design, seed=seed, stop_hits=stop_hits, statistic=perm_statistic,
+                          correction=perm_correction)),
+        Stage('individual_plots', plot_individuals, deps=['preprocess'],
+              inputs=['data/all_df.csv', 'data/file_index.csv', 'data/manifest.json'],
+              outputs=['derivative/individuals'], parallel=True),
+        Stage('group_plots', plot_averages, deps=['cohort'], inputs=COHORT_FILES,
+              outputs=['derivative/average'], params=design, parallel=True),
+        Stage('ttest', run_all_ttest, deps=['cohort'], inputs=COHORT_FILES, outputs=['derivative/ttest'],
+              params=design),
+        Stage('anova', run_all_anova, deps=['preprocess'], inputs=['data/all_df.csv'],
+              outputs=['derivative/anova'], params=design),
+    ]
+
+def select_stages(stages, names):
+    ''' The stages of names and all the stages they depend on'''
+
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f'Unknown stages {unknown}, the stages are {list(by_name)}')
+    selected = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo += by_name[name].deps
+
+    return [stage for stage in stages if stage.name in selected]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the stages of the analysis')
+    parser.add_argument('stages', nargs='*', help='stages to run (with their dependencies), default all')
+    parser.add_argument('--cpus', type=int, default=pipeline_cpus, help='CPU budget, -1 for all the CPUs')
+    parser.add_argument('--force', action='store_true', help='run the stages even if they are up to date')
+    args = parser.parse_args()
+
+    start_trace('pipeline') # opt-in, see trace in utils/params.py
+    stages = pipeline_stages(cpus=args.cpus)
+    if args.stages:
+        try:
+            stages = select_stages(stages, args.stages)
+        except ValueError as e:
+            parser.error(str(e))
+    status = run_stages(stages, cpus=args.cpus, force=args.force)
+    if any(state in ('failed', 'not run') for state in status.values()):
+        raise SystemExit(1)
@@ -1,35 +1,49 @@
 from utils.preproc import *
 from utils.plotting import *
-from utils.params import groups, comparisons
+from utils.params import groups, comparisons, n_jobs
+from utils.cache import ArtifactCache, hash_inputs
+from utils.trace import start_trace
 
 # This script compares the average connectivity matrices of all the pairs of 
 # groups using three different methods: t-test, permutation test and NBS.
-pre_run_check() # check if the data is available and preprocessed
 
-df = pd.read_csv('data/all_df.csv')
-fig1 = plot_grp_box(df)
-fig2 = plot_sexdiff_box(df)
-fig3 = plot_female_box(df)
-fig1.savefig('derivative/average/boxplot/average_connectivity.png', dpi=300)    
-fig2.savefig('derivative/average/boxplot/average_connectivity_sexdiff.png', dpi=300)
-fig3.savefig('derivative/average/boxplot/average_connectivity_female.png', dpi=300)
+def plot_boxplots():
+    ''' Box plots of the average connectivity of each animal, by group and sex'''
 
-# plot the average connectivity matrix of each group, and with females only
+    df = pd.read_csv('data/all_df.csv')
+    boxplots = [(plot_grp_box, 'derivative/average/boxplot/average_connectivity.png'),
+                (plot_sexdiff_box, 'derivative/average/boxplot/average_connectivity_sexdiff.png'),
+                (plot_female_box, 'derivative/average/boxplot/average_connectivity_female.png')]
+    for plot_box, fout in boxplots:
+        key = hash_inputs(plot_box.__name__, df)
+        if not cache.fresh(fout, key):
+            fig = plot_box(df)
+            fig.savefig(fout, dpi=300)
+            plt.close(fig)
+            cache.record(fout, key)
+
+def plot_group_mats(n_jobs=n_jobs):
+    ''' Plots the average connectivity matrix of each group, and with females only,
+    and the differences between groups. The figures are rendered in parallel.'''
+
+    zscore = [True, False]
+    females = [True, False]
+    jobs = []
+    for z in zscore:
+        for female in females:
+            for pop in groups:
+                jobs.append(grp_mat_job(pop, females=female, z=z))
 
-zscore = [True, False]
-females = [True, False]
-for z in zscore:
     for female in females:
-        for pop in groups:
-            plot_grp_mat(pop, females=female, z=z)
-            plt.close('all')
-
-for female in females:
-    for (pop1, pop2) in comparisons:
-        if female == True:
-            fname = f'derivative/average/diff/{pop1}_{pop2}.png'
-        elif female == False:
-            fname = f'derivative/average/diff/females_{pop1}_{pop2}.png'
-        fig = plot_diff_group_mat(pop1, pop2, females=female)
-        fig.savefig(fname, dpi=300)
-        plt.close('all')
\ No newline at end of file
+        for (pop1, pop2) in comparisons:
+            jobs.append(diff_group_job(pop1, pop2, females=female))
+
+    render_jobs(jobs, n_jobs=n_jobs, cache=cache)
+
+cache = ArtifactCache() # skips the figures whose data did not change
+
+if __name__ == '__main__':
+    start_trace('plot_av') # opt-in, see trace in utils/params.py
+    pre_run_check() # check if the data is available and preprocessed
+    plot_boxplots()
+    plot_group_mats()
@@ -1,10 +1,19 @@
 from utils.plotting import *
 from utils.preproc import pre_run_check, zscore_mat
+from utils.params import n_jobs
+from utils.cache import ArtifactCache
+from utils.trace import start_trace
 
 
-pre_run_check()
-desc = pd.read_csv('data/all_df.csv')
-ids = desc['id']
-for id in ids:
-    plot_sgl_mat(id, f'z-scored matrix mouse {id}', f'derivative/individuals/souris_{id}.png')
-    plt.close('all')
\ No newline at end of file
+def plot_individuals(n_jobs=n_jobs):
+    ''' Plots the z-scored matrix of each animal'''
+
+    desc = pd.read_csv('data/all_df.csv')
+    ids = desc['id']
+    jobs = [sgl_mat_job(id, f'z-scored matrix mouse {id}', f'derivative/individuals/souris_{id}.png') for id in ids]
+    render_jobs(jobs, n_jobs=n_jobs, cache=ArtifactCache())
+
+if __name__ == '__main__':
+    start_trace('plot_individuals') # opt-in, see trace in utils/params.py
+    pre_run_check()
+    plot_individuals()
@@ -1,7 +1,10 @@
-from utils.conn import nbs_bct_corr_z, ttest_with_fdr, permutation_test_with_fdr, anova
+from utils.conn import nbs_bct_corr_z, nbs_threshold_sweep, ttest_with_fdr, permutation_test_with_fdr, anova
 from utils.preproc import *
 from utils.plotting import *
-from utils.params import comparisons, groups
+from utils.params import comparisons, groups, seed, n_jobs, stop_hits, perm_statistic, perm_correction
+from utils.params import nbs_thresh, nbs_extent, nbs_k, nbs_sweep_threshs
+from utils.cache import ArtifactCache, ResultStore, hash_inputs
+from utils.trace import start_trace, span, traced
 
 ################################################################################
 # This script compares the average connectivity matrices of all the pairs of
@@ -9,13 +12,10 @@ from utils.params import comparisons, groups
 # Also runs an ANOVA on the mean connectivity values of all the groups.
 ################################################################################
 
+@traced
 def run_anova(*groups, females=False):
     ''' Run an ANOVA on the grouped averaged connectivity values. '''
 
-    F, p = anova(*groups, females=females)
-
-    # save the p-values and F stats in a .csv file
-    df = pd.DataFrame(np.array([F, p]), index=['F-stat', 'pval'], columns=['value'])
     grp_str = '-'.join(groups)
     if len(groups) == 4:
         grp_str = 'all'
@@ -23,110 +23,301 @@ def run_anova(*groups, females=False):
     if females:
         fname = f'anova_res_fem_{grp_str}.csv'
     fout = os.path.join('derivative/anova/', fname)
+    desc = pd.read_csv('data/all_df.csv')
+    desc = desc[desc['group'].isin(groups) & ((desc['sex'] == 'f') | (not females))]
+    key = hash_inputs('anova', groups, females, desc.reset_index(drop=True))
+    if cache.fresh(fout, key):
+        print(f'{fout} is up to date')
+        return
+
+    F, p = anova(*groups, females=females)
+
+    # save the p-values and F stats in a .csv file
+    df = pd.DataFrame(np.array([F, p]), index=['F-stat', 'pval'], columns=['value'])
     df.to_csv(fout, index=True)
+    cache.record(fout, key)
 
 
-def run_stat_comp(comparisons, test='ttest', females=False):
+@traced
+def run_stat_comp(comparisons, test='ttest', females=False, n_permutations=10000, seed=None, stop_hits=None,
+                  statistic='mean_diff', correction='fdr_bh'):
     ''' Run a statistical comparison between the average connectivity matrices of two groups
     using either a t-test or a permutation test. The results are saved in .csv files and figures.
+    Comparisons whose outputs are up to date with the data and parameters are skipped, and
+    the p-values of comparisons already computed are read from the results store.
+    With stop_hits, the permutations of each edge stop early (see permutation_test_with_fdr)
+    and the number of permutations used per edge is saved as well.
+    The permutation test uses the given statistic and correction ('fdr_bh' or 'maxT', see
+    permutation_test_with_fdr).
     '''
 
+    level = 'FWER' if test == 'permutations' and correction == 'maxT' else 'FDR'
+    pending = []
     for pop1, pop2 in comparisons:
 
         if test == 'ttest':
-            raw_pvals, fdr_pvals = ttest_with_fdr(pop1, pop2, females=females)
             outdir = f'derivative/ttest/'
         elif test == 'permutations':
-            raw_pvals, fdr_pvals = permutation_test_with_fdr(pop1, pop2)
             outdir = f'derivative/permutations/'
 
         if females:
             cmp_name = f'fem_{pop1}-vs-{pop2}'
-            title = f'{test} {pop1} - {pop2}, FDR < 0.05 (females)'
+            title = f'{test} {pop1} - {pop2}, {level} < 0.05 (females)'
         else:
             cmp_name = f'{pop1}-vs-{pop2}'
-            title = f'{test} {pop1} - {pop2}, FDR < 0.05'
-
-        np.savetxt(os.path.join(outdir, 'pvals', f'{cmp_name}_pval.csv'), fdr_pvals, delimiter=',')
-
-        # plot (pop1 - pop2) * mask
-        mask = fdr_pvals < 0.05
-        mask = mask.astype(int)
+            title = f'{test} {pop1} - {pop2}, {level} < 0.05'
 
+        outputs = [os.path.join(outdir, 'pvals', f'{cmp_name}_pval.csv'),
+                   os.path.join(outdir, 'figures', f'{cmp_name}.png'),
+                   os.path.join(outdir, 'pvals', 'raw_pvals', f'{cmp_name}_raw_pval.csv'),
+                   os.path.join(outdir, 'figures', 'raw_pvals', f'{cmp_name}_raw_pval.png')]
+        if test == 'permutations':
+            outputs.append(os.path.join(outdir, 'n_perms', f'{cmp_name}_n_perms.csv'))
         av1 = get_av_grp_mat(pop1)
         av2 = get_av_grp_mat(pop2)
-        diff = av1 - av2
-        diff = diff * mask
-
-        fig = plot_mat(diff, title)
-        fig.savefig(os.path.join(outdir, 'figures', f'{cmp_name}.png'), dpi=300) # dpi=300
-
-        # with raw p-values
-        np.savetxt(os.path.join(outdir, 'pvals', 'raw_pvals', f'{cmp_name}_raw_pval.csv'), raw_pvals, delimiter=',')
-        mask = raw_pvals < 0.05
-        mask = mask.astype(int)
-        diff = av1 - av2
-        diff = diff * mask
-
-        fig = plot_mat(diff, f'{test} {pop1} - {pop2}, p < 0.05', vmin=None, vmax=None)
-        fig.savefig(os.path.join(outdir, 'figures', 'raw_pvals', f'{cmp_name}_raw_pval.png'), dpi=300) # dpi=300
-        plt.close('all')
+        params = {}
+        if test == 'permutations':
+            params = {'n_permutations': n_permutations, 'seed': seed, 'stop_hits': stop_hits,
+                      'statistic': statistic, 'correction': correction}
+        res_key = hash_inputs(test, pop1, pop2, females, params, get_ttest_inputs(pop1, pop2, females=females))
+        key = hash_inputs(res_key, title, av1, av2)
+        if cache.all_fresh(outputs, key):
+            print(f'{test} {cmp_name} is up to date')
+            continue
+        pending.append((pop1, pop2, title, outputs, av1, av2, res_key, key))
+
+    def compute(missing):
+        ''' p-values of the pairs missing from the results store'''
+        if test == 'ttest':
+            return {pair: ttest_with_fdr(*pair, females=females) for pair in missing}
+        return {pair: permutation_test_with_fdr(*pair, n_permutations=n_permutations, females=females, seed=seed,
+                                                stop_hits=stop_hits, return_n_used=True, statistic=statistic,
+                                                correction=correction)
+                for pair in missing}
+
+    # p-values from the results store, or computed for the missing pairs
+    stored = results.memo({(pop1, pop2): res_key for pop1, pop2, *_, res_key, _ in pending}, compute)
+
+    for pop1, pop2, title, outputs, av1, av2, res_key, key in pending:
+
+        with span('outputs', test=test, comparison=f'{pop1}-vs-{pop2}', females=females):
+            if test == 'ttest':
+                raw_pvals, fdr_pvals = stored[(pop1, pop2)]
+            elif test == 'permutations':
+                raw_pvals, fdr_pvals, n_used = stored[(pop1, pop2)]
+                np.savetxt(outputs[4], n_used, delimiter=',', fmt='%d')
+
+            np.savetxt(outputs[0], fdr_pvals, delimiter=',')
+
+            # plot (pop1 - pop2) * mask
+            mask = fdr_pvals < 0.05
+            mask = mask.astype(int)
+
+            diff = av1 - av2
+            diff = diff * mask
+
+            fig = plot_mat(diff, title)
+            fig.savefig(outputs[1], dpi=300) # dpi=300
+
+            # with raw p-values
+            np.savetxt(outputs[2], raw_pvals, delimiter=',')
+            mask = raw_pvals < 0.05
+            mask = mask.astype(int)
+            diff = av1 - av2
+            diff = diff * mask
+
+            fig = plot_mat(diff, f'{test} {pop1} - {pop2}, p < 0.05', vmin=None, vmax=None)
+            fig.savefig(outputs[3], dpi=300) # dpi=300
+            plt.close('all')
+            cache.record_all(outputs, key)
     
         
-def run_nbs(comparisons, females=False):
-    ''' Run a Network Based Statistics comparison between the average connectivity matrices of two groups.'''
+@traced
+def run_nbs(comparisons, females=False, thresh=0.15, k=1000, n_jobs=1, seed=None, stop_hits=None, extent=True):
+    ''' Run a Network Based Statistics comparison between the average connectivity matrices of two groups.
+    The size of a component is its number of edges (extent) or the sum of their z values (intensity).
+    The k permutations are split across n_jobs processes, and are reproducible for a given seed.
+    Comparisons whose outputs are up to date with the data and parameters are skipped, and
+    the null distributions of comparisons already computed are read from the results store.
+    With stop_hits, the permutations stop early (see nbs_bct_corr_z) and the saved null
+    distribution only holds the permutations used.
+    The blocks of permutations of each comparison are checkpointed in derivative/nbs/null/, so an
+    interrupted run resumes where it stopped and a larger k extends the existing null distribution.
+    Nothing is saved for the comparisons without a component above the threshold, the others are.'''
 
+    pending = []
     for pop1, pop2 in comparisons:
 
-        stack, y, _, _ = get_nbs_inputs(pop1, pop2, females=females)
-        pval, adj, null = nbs_bct_corr_z(stack, thresh=0.15, y_vec=y, k=1000)
-
         outdir = f'derivative/nbs/'
         if females:
             cmp_name = f'fem_{pop1}-vs-{pop2}'
         else:
             cmp_name = f'{pop1}-vs-{pop2}'
+        outputs = [os.path.join(outdir, 'null', f'{cmp_name}_null.csv'),
+                   os.path.join(outdir, 'pvals', f'{cmp_name}_pval.csv'),
+                   os.path.join(outdir, 'adjacency', f'{cmp_name}_adj.csv'),
+                   os.path.join(outdir, 'figures', f'{cmp_name}.png')]
+
+        stack, y, _, _ = get_nbs_inputs(pop1, pop2, females=females)
+        av1 = get_av_grp_mat(pop1, z=False)
+        av2 = get_av_grp_mat(pop2, z=False)
+        params = {'thresh': thresh, 'k': k, 'seed': seed, 'stop_hits': stop_hits, 'extent': extent}
+        res_key = hash_inputs('nbs', pop1, pop2, females, params, stack, y)
+        key = hash_inputs(res_key, av1, av2)
+        if cache.all_fresh(outputs, key):
+            print(f'nbs {cmp_name} is up to date')
+            continue
+        pending.append((pop1, pop2, cmp_name, outputs, av1, av2, res_key, key))
+
+    def compute(missing):
+        ''' NBS results of the pairs missing from the results store, leaving out the pairs
+        without a component above the threshold'''
+        computed = {}
+        for pop1, pop2, cmp_name, *_ in pending:
+            if (pop1, pop2) not in missing:
+                continue
+            stack, y, _, _ = get_nbs_inputs(pop1, pop2, females=females)
+            ckpt = os.path.join('derivative/nbs/null/', f'{cmp_name}_null.ckpt.npz')
+            try:
+                computed[(pop1, pop2)] = nbs_bct_corr_z(stack, thresh=thresh, y_vec=y, k=k, extent=extent,
+                                                        n_jobs=n_jobs, seed=seed, stop_hits=stop_hits,
+                                                        checkpoint=ckpt)
+            except ValueError as err:
+                print(f'nbs {cmp_name}: {err}')
+        return computed
+
+    # NBS results from the results store, or computed for the missing pairs
+    stored = results.memo({(pop1, pop2): res_key for pop1, pop2, *_, res_key, _ in pending}, compute)
+
+    for pop1, pop2, cmp_name, outputs, av1, av2, res_key, key in pending:
+
+        if (pop1, pop2) not in stored:
+            # no component above the threshold (see nbs_bct_corr_z), the other pairs are still saved
+            print(f'nbs {cmp_name}: no component above the threshold, nothing saved')
+            continue
+        with span('outputs', test='nbs', comparison=cmp_name):
+            pval, adj, null = stored[(pop1, pop2)]
+            print(f'nbs {cmp_name}: {len(null)} permutations used')
+
+            # save the null distribution, p-values and adjacency matrix in .csv files
+            np.savetxt(outputs[0], null, delimiter=',')
+            np.savetxt(outputs[1], pval, delimiter=',')
+            np.savetxt(outputs[2], adj, delimiter=',')
+
+            # group 1 average * adj
+            print(f'--- multipliying {pop1} by adj ---')
+            av1 = av1 * adj
+
+            # group 2 average * adj
+            print(f'--- multipliying {pop2} by adj ---')
+            av2 = av2 * adj
+
+            # (average group 1 - average group 2) * adj
+            print(f'--- multipliying ({pop1} - {pop2}) by adj ---')
+            diff = av1 - av2 
+            pval = np.min(pval)
+            if females:
+                fig3 = plot_mat(diff, f'females - {pop1} < {pop2} - pval={pval}', vmin=None, vmax=None)
+            else:
+                fig3 = plot_mat(diff, f'{pop1} < {pop2} - pval={pval}', vmin=None, vmax=None)
+            fig3.savefig(outputs[3], dpi=300) # dpi=300
+            plt.close('all')
+            cache.record_all(outputs, key)
+
+@traced
+def run_nbs_sweep(comparisons, threshs, females=False, k=1000, n_jobs=1, seed=None, stop_hits=None,
+                  extent=True):
+    ''' Threshold sensitivity analysis of the NBS: runs each comparison for all the thresholds
+    from a single pass of permutations (see nbs_threshold_sweep). The null distribution,
+    p-values and adjacency matrix of each threshold are saved in derivative/nbs/sweep/, with
+    a summary table of the thresholds for each comparison (no component and a NaN minimum
+    p-value for the thresholds that no edge passes).'''
+
+    outdir = 'derivative/nbs/sweep/'
+    for pop1, pop2 in comparisons:
 
-        # save the null distribution, p-values and adjacency matrix in .csv files
-        np.savetxt(os.path.join(outdir, 'null', f'{cmp_name}_null.csv'), null, delimiter=',')
-        np.savetxt(os.path.join(outdir, 'pvals', f'{cmp_name}_pval.csv'), pval, delimiter=',')
-        np.savetxt(os.path.join(outdir, 'adjacency', f'{cmp_name}_adj.csv'), adj, delimiter=',')
-
-        # group 1 average * adj
-        print(f'--- multipliying {pop1} by adj ---')
-        mat_list1 = get_grp_mat(pop1)
-        stack1 = np.stack((mat_list1), axis=-1)
-        av1 = np.mean(stack1, axis=-1)
-        av1 = av1 * adj
-
-        # group 2 average * adj
-        print(f'--- multipliying {pop2} by adj ---')
-        mat_list2 = get_grp_mat(pop2)
-        stack2 = np.stack((mat_list2), axis=-1)
-        av2 = np.mean(stack2, axis=-1)
-        av2 = av2 * adj
-
-        # (average group 1 - average group 2) * adj
-        print(f'--- multipliying ({pop1} - {pop2}) by adj ---')
-        diff = av1 - av2 
-        pval = np.min(pval)
         if females:
-            fig3 = plot_mat(diff, f'females - {pop1} < {pop2} - pval={pval}', vmin=None, vmax=None)
+            cmp_name = f'fem_{pop1}-vs-{pop2}'
         else:
-            fig3 = plot_mat(diff, f'{pop1} < {pop2} - pval={pval}', vmin=None, vmax=None)
-        fig3.savefig(os.path.join(outdir, 'figures', f'{cmp_name}.png'), dpi=300) # dpi=300
-        plt.close('all')
-
-pre_run_check()
-for comp in comparisons:
-    run_anova(*comp)
-    run_anova(*comp, females=True)
-run_anova(*groups)
-run_anova(*groups, females=True)
-run_nbs(comparisons=comparisons, females=False)
-run_nbs(comparisons=comparisons, females=True)
-run_stat_comp(comparisons=comparisons, test='permutations', females=False)
-run_stat_comp(comparisons=comparisons, test='permutations', females=True)
-run_stat_comp(comparisons=comparisons, test='ttest', females=False)
-run_stat_comp(comparisons=comparisons, test='ttest', females=True)
+            cmp_name = f'{pop1}-vs-{pop2}'
+        outputs = [os.path.join(outdir, f'{cmp_name}_summary.csv')]
+        for thresh in threshs:
+            outputs += [os.path.join(outdir, f'{cmp_name}_thr{thresh:g}_{name}.csv')
+                        for name in ('null', 'pval', 'adj')]
+
+        stack, y, _, _ = get_nbs_inputs(pop1, pop2, females=females)
+        params = {'threshs': list(threshs), 'k': k, 'seed': seed, 'stop_hits': stop_hits, 'extent': extent}
+        res_key = hash_inputs('nbs_sweep', pop1, pop2, females, params, stack, y)
+        if cache.all_fresh(outputs, res_key):
+            print(f'nbs sweep {cmp_name} is up to date')
+            continue
+
+        def compute(_):
+            ''' (pval, adj, null) of each threshold, one after the other'''
+            checkpoint = os.path.join('derivative/nbs/null/', f'{cmp_name}_sweep_null.ckpt.npz')
+            sweep = nbs_threshold_sweep(stack, threshs, y, k=k, extent=extent, n_jobs=n_jobs, seed=seed,
+                                        stop_hits=stop_hits, checkpoint=checkpoint)
+            return {cmp_name: [arr for res in sweep for arr in res]}
+
+        stored = results.memo({cmp_name: res_key}, compute)[cmp_name]
+
+        summary = []
+        for i, thresh in enumerate(threshs):
+            pval, adj, null = stored[3 * i:3 * i + 3]
+            np.savetxt(outputs[1 + 3 * i], null, delimiter=',')
+            np.savetxt(outputs[2 + 3 * i], pval, delimiter=',')
+            np.savetxt(outputs[3 + 3 * i], adj, delimiter=',')
+            summary.append({'thresh': thresh, 'n_components': len(pval),
+                            'min_pval': np.min(pval) if len(pval) else np.nan,
+                            'n_edges': np.count_nonzero(adj) // 2, 'n_permutations': len(null)})
+        pd.DataFrame(summary).to_csv(outputs[0], index=False)
+        cache.record_all(outputs, res_key)
+
+def run_all_anova():
+    ''' ANOVAs of each pair of groups and of all the groups, with all the animals and with the
+    females only'''
+
+    for comp in comparisons:
+        run_anova(*comp)
+        run_anova(*comp, females=True)
+    run_anova(*groups)
+    run_anova(*groups, females=True)
+
+def run_all_nbs(n_jobs=n_jobs):
+    ''' NBS of all the comparisons, with all the animals and with the females only, and the
+    threshold sweep if nbs_sweep_threshs is set'''
+
+    run_nbs(comparisons=comparisons, females=False, thresh=nbs_thresh, k=nbs_k, n_jobs=n_jobs, seed=seed,
+            stop_hits=stop_hits, extent=nbs_extent)
+    run_nbs(comparisons=comparisons, females=True, thresh=nbs_thresh, k=nbs_k, n_jobs=n_jobs, seed=seed,
+            stop_hits=stop_hits, extent=nbs_extent)
+    if nbs_sweep_threshs:
+        run_nbs_sweep(comparisons, nbs_sweep_threshs, females=False, k=nbs_k, n_jobs=n_jobs, seed=seed,
+                      stop_hits=stop_hits, extent=nbs_extent)
+        run_nbs_sweep(comparisons, nbs_sweep_threshs, females=True, k=nbs_k, n_jobs=n_jobs, seed=seed,
+                      stop_hits=stop_hits, extent=nbs_extent)
+
+def run_all_permutations():
+    ''' Permutation tests of all the comparisons, with all the animals and with the females only'''
+
+    run_stat_comp(comparisons=comparisons, test='permutations', females=False, seed=seed, stop_hits=stop_hits,
+                  statistic=perm_statistic, correction=perm_correction)
+    run_stat_comp(comparisons=comparisons, test='permutations', females=True, seed=seed, stop_hits=stop_hits,
+                  statistic=perm_statistic, correction=perm_correction)
+
+def run_all_ttest():
+    ''' t-tests of all the comparisons, with all the animals and with the females only'''
+
+    run_stat_comp(comparisons=comparisons, test='ttest', females=False)
+    run_stat_comp(comparisons=comparisons, test='ttest', females=True)
+
+cache = ArtifactCache() # skips the outputs whose inputs and parameters did not change
+results = ResultStore() # p-values and nulls already computed for the same data and parameters
 
+if __name__ == '__main__':
+    start_trace('stats') # opt-in, see trace in utils/params.py
+    pre_run_check()
+    run_all_anova()
+    run_all_nbs()
+    run_all_permutations()
+    run_all_ttest()
@@ -0,0 +1,233 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# bump to invalidate every cached artifact (e.g. when the figures change)
+CACHE_VERSION = 1
+ARTIFACT_DIR = 'derivative/.artifacts'
+# bump to invalidate every stored statistical result (e.g. when a test changes)
+RESULTS_VERSION = 2
+RESULTS_DIR = 'derivative/.results'
+RESULTS_MAX_BYTES = 512 * 2**20
+
+def hash_inputs(*parts):
+    ''' Content hash of the inputs and parameters of a result. Accepts numpy arrays,
+    pandas objects, strings, numbers, None and (nested) lists, tuples and dicts of them.'''
+
+    h = hashlib.sha256()
+
+    def update(part):
+        if isinstance(part, np.ndarray) and part.dtype.hasobject: # e.g. strings, hash the values
+            h.update(f'ndarray{part.shape}'.encode())
+            h.update(repr(part.tolist()).encode())
+        elif isinstance(part, np.ndarray):
+            arr = np.ascontiguousarray(part)
+            h.update(f'ndarray{arr.dtype.str}{arr.shape}'.encode())
+            h.update(arr.tobytes())
+        elif hasattr(part, 'to_numpy') and hasattr(part, 'columns'): # DataFrame
+            update(list(map(str, part.columns)))
+            for col in part.columns:
+                update(part[col].to_numpy())
+        elif hasattr(part, 'to_numpy'): # Series, Index
+            update(part.to_numpy())
+        elif isinstance(part, (list, tuple)):
+            h.update(f'{type(part).__name__}{len(part)}'.encode())
+            for item in part:
+                update(item)
+        elif isinstance(part, dict):
+            update(sorted(part.items(), key=lambda item: str(item[0])))
+        else:
+            h.update(f'{type(part).__name__}:{part!r};'.encode())
+
+    for part in parts:
+        update(part)
+
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    ''' Records, for each output file under derivative/, the hash of the inputs and parameters
+    it was made from, so that up-to-date outputs can be skipped.
+
+    Each output has its own small record file, so several processes can use the cache at the
+    same time.
+    '''
+
+    def __init__(self, root=ARTIFACT_DIR):
+        self.root = root
+
+    def _record_path(self, fout):
+        name = hashlib.sha1(os.path.normpath(fout).encode()).hexdigest()
+        return os.path.join(self.root, name + '.json')
+
+    def fresh(self, fout, key):
+        ''' True if fout exists and was made from inputs with this key'''
+
+        if not os.path.exists(fout):
+            return False
+        try:
+            with open(self._record_path(fout)) as f:
+                record = json.load(f)
+            return record['key'] == key and record.get('version') == CACHE_VERSION
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def all_fresh(self, fouts, key):
+        return all(self.fresh(fout, key) for fout in fouts)
+
+    def record(self, fout, key):
+        ''' Record that fout was (re)made from inputs with this key'''
+
+        os.makedirs(self.root, exist_ok=True)
+        path = self._record_path(fout)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'path': fout, 'key': key, 'version': CACHE_VERSION}, f)
+        os.replace(tmp_path, path)
+
+    def record_all(self, fouts, key):
+        for fout in fouts:
+            self.record(fout, key)
+
+
+class ResultStore:
+    ''' Stores the arrays returned by the statistical tests (p-values, adjacency, null
+    distributions), keyed by a hash of the comparison, the parameters and the data, so that
+    they are not recomputed when only the figures need to be redone.
+
+    The store is bounded to max_bytes: the least recently used results are evicted first.
+    '''
+
+    def __init__(self, root=RESULTS_DIR, max_bytes=RESULTS_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.root, f'v{RESULTS_VERSION}_{key}.npz')
+
+    def get(self, key):
+        ''' Return the tuple of arrays stored under key, or None if there is none'''
+
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = tuple(npz[f'arr_{i}'] for i in range(len(npz.files)))
+            os.utime(path) # mark as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays
+
+    def put(self, key, *arrays):
+        ''' Store the arrays under key, then evict the least recently used results if the
+        store is over budget'''
+
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, *arrays)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def memo(self, keys, func):
+        ''' Return the stored results of several computations ({name: key} -> {name: tuple of
+        arrays}). The missing ones are computed together with func(missing names), which
+        returns {name: tuple of arrays}, and stored. The names func leaves out have no result
+        and are left out.'''
+
+        stored = {name: self.get(key) for name, key in keys.items()}
+        missing = [name for name, arrays in stored.items() if arrays is None]
+        if missing:
+            for name, arrays in func(missing).items():
+                stored[name] = tuple(np.asarray(a) for a in arrays)
+                self.put(keys[name], *stored[name])
+
+        return {name: arrays for name, arrays in stored.items() if arrays is not None}
+
+    def evict(self, keep=None):
+        ''' Remove the least recently used results until the store fits in max_bytes'''
+
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class NullCheckpoint:
+    ''' Blocks of a permutation null distribution saved to disk as they are computed, so that an
+    interrupted run resumes where it stopped and an existing null can be extended with more
+    permutations.
+
+    Block b of a run is drawn from the random stream (entropy, b), so the entropy and the
+    indices of the saved blocks are the whole state of the random generator. The saved blocks
+    are only reused if config (a hash of the data and of the parameters that change the null
+    values) and the entropy are the same. The values of a block are along its last axis.
+    '''
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.entropy = None
+        self.blocks = {}
+        self._unsaved = 0
+        try:
+            with np.load(path) as ckpt:
+                if str(ckpt['config']) == config:
+                    self.entropy = str(ckpt['entropy'])
+                    stops = np.cumsum(ckpt['sizes'])
+                    values = ckpt['values']
+                    self.blocks = {int(chunk): values[..., stop - size:stop]
+                                   for chunk, size, stop in zip(ckpt['chunks'], ckpt['sizes'], stops)}
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def use_entropy(self, entropy):
+        ''' Keeps the saved blocks only if they were drawn from the streams of entropy'''
+
+        entropy = str(entropy)
+        if entropy != self.entropy:
+            self.entropy = entropy
+            self.blocks = {}
+
+    def get(self, chunk, size):
+        ''' The saved values of block chunk, or None if it is not saved with that size'''
+
+        values = self.blocks.get(chunk)
+        if values is None or values.shape[-1] != size:
+            return None
+        return values
+
+    def add(self, chunk, values, every=10):
+        ''' Adds the values of a block, saving to disk every few new blocks'''
+
+        self.blocks[chunk] = np.asarray(values)
+        self._unsaved += 1
+        if self._unsaved >= every:
+            self.save()
+
+    def save(self):
+        if not self._unsaved:
+            return
+
+        chunks = sorted(self.blocks)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, config=self.config, entropy=self.entropy, chunks=np.array(chunks, dtype=int),
+                     sizes=np.array([self.blocks[c].shape[-1] for c in chunks], dtype=int),
+                     values=np.concatenate([self.blocks[c] for c in chunks], axis=-1))
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
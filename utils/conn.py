@@ -1,14 +1,24 @@
 from __future__ import division
+import os
+import math
+from itertools import combinations
 import numpy as np
 import pandas as pd
 from scipy import stats
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from statsmodels.stats.multitest import multipletests
 from utils.preproc import get_ttest_inputs, back2mat
+from utils.parallel import map_chunks
+from utils.cache import NullCheckpoint, hash_inputs
+from utils.trace import traced, count
+from utils.edges import triu_indices
 
 #############################################################################
 # Permutation test and t-test with FDR correction
 #############################################################################
 
+@traced
 def anova(*pops, females=False):
     ''' Performs a one-way ANOVA on the averaged connectivity matrices of 
     multiple groups.'''
@@ -32,6 +42,7 @@ def anova(*pops, females=False):
     
     return F, p
 
+@traced
 def ttest_with_fdr(pop1, pop2, alpha=0.05, females=False):
     ''' Performs a t-test on each coordinate of two groups of matrices
     and corrects p-values using False Discovery Rate (FDR).
@@ -66,10 +77,14 @@ def ttest_with_fdr(pop1, pop2, alpha=0.05, females=False):
 
     return raw_pvals, fdr_pvals
 
-def permutation_test_with_fdr(pop1, pop2, n_permutations=10000, alpha=0.05, females=False):
+@traced
+def permutation_test_with_fdr(pop1, pop2, n_permutations=10000, alpha=0.05, females=False,
+                              block_size=1000, seed=None, stop_hits=None, return_n_used=False,
+                              statistic='mean_diff', correction='fdr_bh'):
     '''
     Performs a permutation test on each coordinate of two groups of matrices
-    and corrects p-values using False Discovery Rate (FDR).
+    and corrects p-values using False Discovery Rate (FDR), or the family-wise
+    error rate with the max-statistic method.
     
     Parameters:
     ----------
@@ -78,49 +93,338 @@ def permutation_test_with_fdr(pop1, pop2, n_permutations=10000, alpha=0.05, fema
     pop2 : str
         Name of the second group.
     n_permutations : int 
-        Number of permutations for the test.
+        Number of permutations for the test. If the groups have no more distinct label
+        splits than that, all of them are enumerated instead (exact test).
     alpha :float 
         Significance level for FDR correction.
+    females : bool
+        If True, only load the matrices of female mice. Default is False.
+    block_size : int
+        Number of permutations evaluated together in one matrix product.
+    seed : int | None
+        Seed of the random generator. Default is None (fresh entropy).
+    stop_hits : int | None
+        If set, sequential mode (Besag & Clifford, 1991): the permutations of a coordinate
+        stop as soon as stop_hits permuted statistics are at least as extreme as the observed
+        one, and its p-value is stop_hits / (number of permutations used). Coordinates that
+        never reach stop_hits use all the n_permutations. Default is None (always run all).
+    return_n_used : bool
+        If True, also return the number of permutations used for each coordinate.
+    statistic : str
+        Statistic of each coordinate: 'mean_diff' (difference of the group means) or 'welch'
+        (Welch t statistic). Default is 'mean_diff'.
+    correction : str
+        'fdr_bh' (Benjamini-Hochberg FDR) or 'maxT': family-wise error rate from the null
+        distribution of the maximum |statistic| over all the coordinates, taken from the same
+        permutations. Only the maximum of each permutation is kept. 'maxT' cannot be combined
+        with stop_hits. Default is 'fdr_bh'.
         
     Returns:
     ----------
     raw_pvals : numpy.ndarray
         Raw p-values for each coordinate in shape (n_edges, n_edges).
     adj_pvals : numpy.ndarray
-        FDR-adjusted p-values for each coordinate. Same shape as raw_pvals.
+        FDR- or FWER-adjusted p-values for each coordinate. Same shape as raw_pvals.
+    n_used : numpy.ndarray
+        Number of permutations used for each coordinate. Same shape as raw_pvals. Only
+        returned if return_n_used is True.
     '''
 
+    check_correction(correction, stop_hits)
     arr1, arr2 = get_ttest_inputs(pop1, pop2, females=females)
-    n_samples1 = arr1.shape[0]
-    n_coords = arr1.shape[1]
-    
-    # Compute observed test statistic (difference in means)
-    obs_stat = np.mean(arr1, axis=0) - np.mean(arr2, axis=0)
-    
-    # Combine data for permutation
-    combined_data = np.vstack([arr1, arr2])
-    n_combined = combined_data.shape[0]
-    
-    # Permutation test
-    perm_stats = np.zeros((n_permutations, n_coords))
-    for i in range(n_permutations):
-        # Shuffle labels
-        perm_indices = np.random.permutation(n_combined)
-        perm_group1 = combined_data[perm_indices[:n_samples1], :]
-        perm_group2 = combined_data[perm_indices[n_samples1:], :]
-        
-        # Compute permuted statistic
-        perm_stats[i, :] = np.mean(perm_group1, axis=0) - np.mean(perm_group2, axis=0)
-    
+    rng = np.random.default_rng(seed)
+    _, counts, n_used, max_counts = perm_mean_diff_counts(arr1, arr2, n_permutations=n_permutations,
+                                                          block_size=block_size, rng=rng,
+                                                          stop_hits=stop_hits, statistic=statistic,
+                                                          max_stat=correction == 'maxT')
+    count('permutations', int(np.max(n_used)))
+
+    return perm_pvals(counts, n_used, n_permutations, alpha=alpha, stop_hits=stop_hits,
+                      return_n_used=return_n_used, max_counts=max_counts)
+
+def check_correction(correction, stop_hits):
+    ''' Checks the multiple comparisons correction of a permutation test.'''
+
+    if correction not in ('fdr_bh', 'maxT'):
+        raise ValueError(f"Unknown correction {correction}, use 'fdr_bh' or 'maxT'")
+    if correction == 'maxT' and stop_hits is not None:
+        raise ValueError('The maxT correction needs all the permutations of all the coordinates, '
+                         'it cannot be combined with stop_hits')
+
+def perm_label_block(n1, n2, size, rng):
+    ''' Draws a block of random group assignments for a two-sample permutation test.
+
+    Parameters
+    ----------
+    n1 : int
+        Number of samples in the first group.
+    n2 : int
+        Number of samples in the second group.
+    size : int
+        Number of permutations in the block.
+    rng : numpy.random.Generator
+        Random generator used to shuffle the labels.
+
+    Returns
+    -------
+    member : numpy.ndarray
+        Boolean array of shape (size, n1 + n2), True where a sample is assigned to group 1.
+    '''
+
+    member = np.zeros((size, n1 + n2), dtype=bool)
+    member[:, :n1] = True
+
+    return rng.permuted(member, axis=1)
+
+def n_relabellings(labels):
+    ''' Number of distinct rearrangements of a label vector, e.g. C(n1 + n2, n1) for two
+    groups of sizes n1 and n2.'''
+
+    _, counts = np.unique(labels, return_counts=True)
+    n_total = math.factorial(len(labels))
+    for c in counts:
+        n_total //= math.factorial(c)
+
+    return n_total
+
+def unique_relabellings(labels):
+    ''' Enumerates all the distinct rearrangements of a label vector, for exact permutation
+    tests.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        1D array of labels, possibly repeated (e.g. group memberships).
+
+    Returns
+    -------
+    relabelled : numpy.ndarray
+        Array of shape (n_relabellings(labels), len(labels)), one rearrangement per row.
+    '''
+
+    values, codes = np.unique(labels, return_inverse=True)
+    n = len(labels)
+    assigned = np.full((1, n), -1)
+
+    # place the values one after the other on every combination of the free positions
+    for v in range(len(values) - 1):
+        free = np.nonzero(assigned == -1)[1].reshape(len(assigned), -1)
+        combos = np.array(list(combinations(range(free.shape[1]), np.sum(codes == v))), dtype=int)
+        rows = np.repeat(np.arange(len(assigned)), len(combos))
+        assigned = assigned[rows]
+        pos = free[rows[:, np.newaxis], np.tile(combos, (len(free), 1))]
+        np.put_along_axis(assigned, pos, v, axis=1)
+    assigned[assigned == -1] = len(values) - 1
+
+    return values[assigned]
+
+def mean_diff_weights(member):
+    ''' Turns group assignments into weights such that weights @ data gives the
+    difference of the group means (group 1 - group 2) for each assignment.'''
+
+    n1 = np.sum(member, axis=-1, keepdims=True)
+    n2 = member.shape[-1] - n1
+
+    return np.where(member, 1 / n1, -1 / n2)
+
+def welch_t(s1, q1, s, q, n1, n2):
+    ''' Welch t statistic of group 1 vs group 2, from the sums s1 and sums of squares q1 of
+    group 1 and the sums s and sums of squares q of both groups (broadcast together).'''
+
+    m1 = s1 / n1
+    m2 = (s - s1) / n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v1 = np.maximum(q1 - n1 * m1**2, 0) / (n1 - 1)
+        v2 = np.maximum(q - q1 - n2 * m2**2, 0) / (n2 - 1)
+        return (m1 - m2) / np.sqrt(v1 / n1 + v2 / n2)
+
+def perm_label_blocks(n1, n2, n_permutations, block_size, rng):
+    ''' Blocks of group assignments for a two-sample permutation test: random ones, or all
+    the distinct label splits if there are no more than n_permutations (exact test).
+
+    Returns
+    -------
+    n_permutations : int
+        Number of permutations in the blocks (the number of splits for an exact test).
+    exact : bool
+        True if all the label splits are enumerated.
+    blocks : generator of numpy.ndarray
+        Boolean arrays of shape (size, n1 + n2), see perm_label_block.
+    '''
+
+    identity = np.arange(n1 + n2) < n1
+    if n_relabellings(identity) <= n_permutations:
+        splits = unique_relabellings(identity)
+        print(f'exact test: all {len(splits)} label splits enumerated')
+        return len(splits), True, (splits[start:start + block_size]
+                                   for start in range(0, len(splits), block_size))
+
+    return n_permutations, False, (perm_label_block(n1, n2, min(block_size, n_permutations - start), rng)
+                                   for start in range(0, n_permutations, block_size))
+
+def perm_mean_diff_counts(arr1, arr2, n_permutations=10000, block_size=1000, rng=None,
+                          stop_hits=None, statistic='mean_diff', max_stat=False):
+    ''' Batched permutation engine for the difference in means of two groups.
+
+    Permutations are drawn in blocks of label matrices and all the group-mean differences 
+    of a block are computed with a single matrix product. Only the number of permuted 
+    statistics at least as extreme as the observed one is kept for each coordinate, so
+    memory does not grow with the number of permutations.
+
+    If there are no more distinct label splits, C(n1 + n2, n1), than n_permutations, all of
+    them are enumerated instead (exact test, the observed split included) and stop_hits is
+    ignored.
+
+    Parameters
+    ----------
+    arr1 : np.ndarray
+        Data of the first group, shape (n_samples1, n_coords).
+    arr2 : np.ndarray
+        Data of the second group, shape (n_samples2, n_coords).
+    n_permutations : int
+        Number of permutations.
+    block_size : int
+        Number of permutations evaluated together.
+    rng : numpy.random.Generator | None
+        Random generator. Default is None (fresh entropy).
+    stop_hits : int | None
+        If set, a coordinate stops being permuted as soon as its count reaches stop_hits
+        (sequential Besag-Clifford test). The label blocks drawn do not depend on which
+        coordinates are still running, so the counts are those of the full run truncated
+        at the stopping point. Default is None (run all the permutations).
+    statistic : str
+        'mean_diff' (difference in means) or 'welch' (Welch t statistic, from the group sums
+        and sums of squares of each block). The Welch statistic is NaN for a group of one
+        sample or a coordinate without variance. Default is 'mean_diff'.
+    max_stat : bool
+        If True, also keep the maximum |stat| over all the coordinates of each permutation,
+        for the max-statistic FWER correction. Cannot be combined with stop_hits.
+
+    Returns
+    -------
+    obs_stat : np.ndarray
+        Observed statistic, shape (n_coords,).
+    counts : np.ndarray
+        Number of permutations with |stat| >= |obs_stat|, shape (n_coords,). NaN where
+        obs_stat is NaN.
+    n_used : np.ndarray
+        Number of permutations used for each coordinate, shape (n_coords,).
+    max_counts : np.ndarray | None
+        Number of permutations whose maximum |stat| is >= |obs_stat|, shape (n_coords,).
+        The maxima ignore the NaN statistics. NaN where obs_stat is NaN, None if max_stat
+        is False.
+    '''
+
+    if statistic not in ('mean_diff', 'welch'):
+        raise ValueError(f"Unknown statistic {statistic}, use 'mean_diff' or 'welch'")
+    if max_stat and stop_hits is not None:
+        raise ValueError('max_stat needs all the permutations of all the coordinates')
+
+    rng = np.random.default_rng() if rng is None else rng
+    n1, n2 = len(arr1), len(arr2)
+    data = np.vstack([arr1, arr2])
+    n_coords = data.shape[1]
+    if statistic == 'welch':
+        # the group sums and sums of squares of a block come from one product with [x, x**2]
+        data = np.hstack([data, data**2])
+        sums = np.sum(data, axis=0)
+        s, q = sums[:n_coords], sums[n_coords:]
+
+    def block_stats(products, coords):
+        ''' Statistics of the coordinates coords, from the products of the label weights with
+        the data columns'''
+        if statistic == 'mean_diff':
+            return products
+        half = products.shape[-1] // 2
+        return welch_t(products[..., :half], products[..., half:], s[coords], q[coords], n1, n2)
+
+    def label_weights(member):
+        ''' Weights of the samples such that weights @ data gives the statistic inputs: the
+        mean differences, or the group 1 sums and sums of squares'''
+        return mean_diff_weights(member) if statistic == 'mean_diff' else member
+
+    # Compute observed test statistic the same way as the permuted ones. The matrix
+    # products of different shapes can still round differently, so the comparison
+    # has a relative tolerance: labellings equivalent to the observed one count
+    identity = np.arange(n1 + n2) < n1
+    obs_stat = block_stats(label_weights(identity) @ data, np.arange(n_coords))
+    abs_obs = np.abs(obs_stat) * (1 - 1e-12)
+
+    n_permutations, exact, blocks = perm_label_blocks(n1, n2, n_permutations, block_size, rng)
+    if exact:
+        stop_hits = None
+    counts = np.zeros(n_coords, dtype=np.int64)
+    n_used = np.full(n_coords, n_permutations, dtype=np.int64)
+    active = np.arange(n_coords) # coordinates still being permuted
+    done_perms = 0
+    maxima = []
+    for member in blocks:
+        data_cols = active if statistic == 'mean_diff' else np.concatenate([active, active + n_coords])
+        # only the coordinates still being permuted enter the product
+        block_data = data if len(active) == n_coords else data[:, data_cols]
+        block = block_stats(label_weights(member) @ block_data, active) # (size, n_active)
+        np.abs(block, out=block)
+        if max_stat:
+            maxima.append(np.nanmax(block, axis=1))
+        exceed = block >= abs_obs[active]
+        if stop_hits is None:
+            counts += np.sum(exceed, axis=0)
+        else:
+            # running counts within the block, to find the permutation where each coordinate stops
+            hits = counts[active] + np.cumsum(exceed, axis=0)
+            done = hits[-1] >= stop_hits
+            n_used[active[done]] = done_perms + np.argmax(hits[:, done] >= stop_hits, axis=0) + 1
+            counts[active] = np.minimum(hits[-1], stop_hits)
+            active = active[~done]
+        done_perms += len(member)
+        if len(active) == 0:
+            break
+
+    # FWER counts from the null distribution of the maximum statistic
+    max_counts = None
+    if max_stat:
+        null_max = np.sort(np.concatenate(maxima))
+        max_counts = len(null_max) - np.searchsorted(null_max, abs_obs, side='left')
+
+    # a NaN observed statistic is never exceeded, its counts would read as significant
+    untested = np.isnan(obs_stat)
+    counts = np.where(untested, np.nan, counts)
+    if max_stat:
+        max_counts = np.where(untested, np.nan, max_counts)
+
+    return obs_stat, counts, n_used, max_counts
+
+def perm_pvals(counts, n_used, n_permutations, alpha=0.05, stop_hits=None, return_n_used=False,
+               max_counts=None):
+    ''' p-values of the permutation test from the counts of extreme permuted statistics,
+    converted to matrices (see permutation_test_with_fdr). The adjusted p-values are
+    FWER-corrected from max_counts (maxT) if given, else FDR-corrected. The p-values of
+    the coordinates with NaN counts are NaN and left out of the FDR correction.'''
+
+    if stop_hits is not None:
+        print(f'permutations used per edge: median {np.median(n_used):.0f}, '
+              f'total {np.sum(n_used)} of {n_permutations * len(n_used)}')
+
     # Calculate p-values
-    raw_pvals = np.mean(np.abs(perm_stats) >= np.abs(obs_stat), axis=0)
+    raw_pvals = counts / n_used
     
-    # FDR correction using Benjamini-Hochberg
-    _, fdr_pvals, _, _ = multipletests(raw_pvals, alpha=alpha, method='fdr_bh')
+    if max_counts is not None:
+        # FWER correction, max-statistic method
+        fdr_pvals = max_counts / n_used
+    else:
+        # FDR correction using Benjamini-Hochberg
+        tested = ~np.isnan(raw_pvals)
+        fdr_pvals = np.full(len(raw_pvals), np.nan)
+        if np.any(tested):
+            _, fdr_pvals[tested], _, _ = multipletests(raw_pvals[tested], alpha=alpha, method='fdr_bh')
 
     raw_pvals = back2mat(raw_pvals) # convert to matrix
     fdr_pvals = back2mat(fdr_pvals)
 
+    if return_n_used:
+        n_used = back2mat(n_used)
+        np.fill_diagonal(n_used, 0) # no test on the diagonal
+        return raw_pvals, fdr_pvals, n_used
     return raw_pvals, fdr_pvals
 
 
@@ -189,42 +493,148 @@ def get_components(A, no_depend=False):
     result) is not guaranteed to be identical the value returned in BCT,
     matlab code, although the component topology is.
 
-    Many thanks to Nick Cullen for providing this implementation
+    Components are labelled with scipy.sparse.csgraph in linear time, in
+    order of their lowest-numbered node.
     '''
 
     if not np.all(A == A.T):  # ensure matrix is undirected
         raise BCTParamError('get_components can only be computed for undirected'
                             ' matrices.  If your matrix is noisy, correct it with np.around')
-    
-    A = binarize(A, copy=True)
-    n = len(A)
-    np.fill_diagonal(A, 1)
-
-    edge_map = [{u,v} for u in range(n) for v in range(n) if A[u,v] == 1]
-    union_sets = []
-    for item in edge_map:
-        temp = []
-        for s in union_sets:
-
-            if not s.isdisjoint(item):
-                item = s.union(item)
-            else:
-                temp.append(s)
-        temp.append(item)
-        union_sets = temp
 
-    comps = np.array([i+1 for v in range(n) for i in 
-        range(len(union_sets)) if v in union_sets[i]])
-    comp_sizes = np.array([len(s) for s in union_sets])
+    comps, comp_sizes = get_components_batch(A[np.newaxis])
+
+    return comps[0], comp_sizes[0]
+
+def get_components_batch(A):
+    '''
+    Batched version of get_components: labels the components of many undirected
+    graphs at once, by treating the stack as one block-diagonal sparse graph.
+
+    Parameters
+    ----------
+    A : PxNxN np.ndarray
+        stack of P binary undirected adjacency matrices
+
+    Returns
+    -------
+    comps : PxN np.ndarray
+        component assignments for each node of each graph, starting at 1 in
+        every graph
+    comp_sizes : list of P np.ndarray
+        component sizes of each graph
+    '''
+
+    if not np.all(A == A.transpose(0, 2, 1)):  # ensure matrices are undirected
+        raise BCTParamError('get_components can only be computed for undirected'
+                            ' matrices.  If your matrix is noisy, correct it with np.around')
+
+    n_graphs, n, _ = A.shape
+    g, i, j = np.nonzero(A)
+    n_comps, labels = _label_block_diag(g * n + i, g * n + j, n_graphs * n)
+
+    # renumber the components of each graph from 1, keeping their relative order
+    node_graph = np.repeat(np.arange(n_graphs), n)
+    keys, local = np.unique(node_graph * n_comps + labels, return_inverse=True)
+    comps_per_graph = np.bincount(keys // n_comps, minlength=n_graphs)
+    first = np.cumsum(comps_per_graph) - comps_per_graph
+    comps = (local - first[node_graph] + 1).reshape(n_graphs, n)
+
+    sizes = np.bincount(local, minlength=len(keys))
+    comp_sizes = np.split(sizes, np.cumsum(comps_per_graph)[:-1])
 
     return comps, comp_sizes
 
+def _label_block_diag(rows, cols, n_nodes):
+    ''' Labels the connected components of the undirected graph with n_nodes nodes and
+    edges (rows[i], cols[i]). Returns the number of components and the label of each node.'''
+
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                       shape=(n_nodes, n_nodes))
+
+    return connected_components(graph, directed=False)
+
+def max_component_sizes(supra, ixes, n, weights=None):
+    '''
+    Size of the largest component of many suprathreshold graphs, labelled in
+    one pass.
+
+    Parameters
+    ----------
+    supra : PxM np.ndarray
+        boolean array, True where an edge is suprathreshold, for P graphs and
+        the M edges indexed by ixes
+    ixes : tuple of np.ndarray
+        row and column indices of the M edges
+    n : int
+        number of nodes
+    weights : PxM np.ndarray | None
+        edge weights. If None, the size of a component is its number of edges
+        (extent), otherwise the sum of the weights of its edges (intensity)
+
+    Returns
+    -------
+    max_sz : Px1 np.ndarray
+        size of the largest component of each graph, 0 if no edge survives
+    '''
+
+    n_graphs = supra.shape[0]
+    g, e = np.nonzero(supra)
+    rows = g * n + ixes[0][e]
+    n_comps, labels = _label_block_diag(rows, g * n + ixes[1][e], n_graphs * n)
+
+    w = None if weights is None else weights[g, e]
+    sizes = np.bincount(labels[rows], weights=w, minlength=n_comps)
+
+    comp_graph = np.zeros(n_comps, dtype=int)
+    comp_graph[labels] = np.repeat(np.arange(n_graphs), n)
+    max_sz = np.zeros(n_graphs)
+    np.maximum.at(max_sz, comp_graph, sizes)
+
+    return max_sz
+
 
 ######################
 # The NBS functinon is stolen from https://github.com/GidLev/NBS-correlation
 ######################
 
-def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False):
+def standardize_rows(x):
+    ''' Centers each row of x and scales it to unit norm, so that the Pearson correlation
+    of two standardized rows is their dot product.'''
+
+    xm = x - np.mean(x, axis=-1, keepdims=True)
+
+    return xm / np.linalg.norm(xm, axis=-1, keepdims=True)
+
+def corr_z(xs, ys):
+    ''' Fisher z-transformed Pearson correlation between every row of xs and every row of ys.
+
+    Parameters
+    ----------
+    xs : np.ndarray
+        Standardized data (see standardize_rows), shape (n_edges, n_subjects).
+    ys : np.ndarray
+        Standardized (permuted) external variables, shape (n_vectors, n_subjects).
+
+    Returns
+    -------
+    z : np.ndarray
+        Fisher z values, shape (n_edges, n_vectors).
+    '''
+
+    return fisher_z(xs @ ys.T)
+
+def fisher_z(r):
+    ''' Fisher z-transform of correlation coefficients.'''
+
+    r = np.clip(r, -1.0, 1.0)
+    with np.errstate(divide='ignore'):
+        z = 0.5 * np.log((1 + r)/(1 - r))
+
+    return z
+
+@traced
+def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False, block_size=100,
+                   n_jobs=1, seed=None, stop_hits=None, checkpoint=None):
 
     '''
     Performs the NBS for matrices [corr_arr] and vector [y_vec]  for a Pearson's r-statistic threshold of
@@ -242,9 +652,33 @@ def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False):
         minimum Pearson's r-value used as threshold
     k : int
         number of permutations used to estimate the empirical null
-        distribution, recommended - 10000
+        distribution, recommended - 10000. If y_vec has no more than k
+        distinct rearrangements, all of them are enumerated instead (exact
+        null distribution, of that length) and stop_hits is ignored
     verbose : bool
         print some extra information each iteration. defaults value = False
+    block_size : int
+        number of permutations whose edge statistics are computed together
+        in one matrix product. Each block draws from its own random stream,
+        so the null distribution depends on block_size. defaults value = 100
+    n_jobs : int
+        number of processes the permutation blocks are split across, -1 for
+        all the CPUs. defaults value = 1
+    seed : int | None
+        seed of the permutations. For a given seed (and block_size), the null
+        distribution is the same whatever n_jobs. defaults value = None
+    stop_hits : int | None
+        if set, sequential mode (Besag & Clifford, 1991): the permutations
+        stop as soon as stop_hits permutation maxima are at least as large as
+        the largest observed component, since its p-value can then no longer
+        be small. The null distribution returned is truncated to the
+        permutations used. defaults value = None (always run the k permutations)
+    checkpoint : str | None
+        path of a checkpoint file (.npz) where the blocks of the null
+        distribution are saved as they are computed. A run with the same data
+        and parameters resumes from the saved blocks, also with a larger k to
+        extend the null. Without a seed, the random streams of the checkpoint
+        are reused. defaults value = None (no checkpoint)
 
     Returns
     -------
@@ -259,7 +693,7 @@ def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False):
         edges are assigned indexed values.
     null : Kx1 np.ndarray
         A vector of K sampled from the null distribution of maximal component
-        size.
+        size. With stop_hits, K is the number of permutations actually used.
 
     Notes
     -----
@@ -307,11 +741,94 @@ def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False):
 
     '''
 
-    def corr_with_vars(x, y):
-        # check correlation X -> M (Sobel's test)
-        r, _ = stats.pearsonr(x, y)
-        z = 0.5 * np.log((1 + r)/(1 - r))
-        return z.item(0)
+    n, ixes, xs, ys, z_stat = _nbs_edge_stats(corr_arr, y_vec)
+    adj, sz_links, max_sz = _nbs_observed(z_stat, ixes, n, thresh, extent)
+
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = NullCheckpoint(checkpoint, hash_inputs('nbs', xs, ys, thresh, extent, block_size))
+        seed = _checkpoint_seed(ckpt, seed)
+
+    k, exact, blocks = nbs_perm_blocks(y_vec, ys, k, block_size, seed)
+    if exact:
+        stop_hits = None
+    shared = (xs, ys, ixes, n, thresh, extent)
+    null_chunks = _resume_chunks(_nbs_null_chunk, shared, blocks, n_jobs, ckpt)
+    null = _nbs_collect_null(null_chunks, k, max_sz, stop_hits=stop_hits, verbose=verbose)
+    count('permutations', len(null))
+
+    return _nbs_pvals(null, sz_links), adj, null
+
+@traced
+def nbs_threshold_sweep(corr_arr, threshs, y_vec, k=1000, extent=True, verbose=False, block_size=100,
+                        n_jobs=1, seed=None, stop_hits=None, checkpoint=None):
+    '''
+    Performs the NBS of nbs_bct_corr_z for several thresholds from a single
+    pass of permutations: the permuted edge statistics of a block are
+    computed once, and the components of the suprathreshold graphs of all
+    the thresholds are labelled together.
+
+    Parameters
+    ----------
+    threshs : list of float
+        the minimum Fisher z values used as thresholds
+    corr_arr, y_vec, k, extent, verbose, block_size, n_jobs, seed, stop_hits, checkpoint :
+        see nbs_bct_corr_z. With a seed, the results for each threshold are
+        the ones of nbs_bct_corr_z with that threshold. With stop_hits, the
+        remaining blocks are only skipped once every threshold has stopped.
+
+    Returns
+    -------
+    results : list of tuple
+        for each threshold, the (pval, adj, null) tuple returned by
+        nbs_bct_corr_z. For a threshold with no component (where
+        nbs_bct_corr_z raises a ValueError), pval is empty and adj is zero,
+        and null holds the permutations run for the other thresholds (max
+        component size 0 for the stopping rule).
+    '''
+
+    threshs = np.asarray(threshs, dtype=float)
+    n, ixes, xs, ys, z_stat = _nbs_edge_stats(corr_arr, y_vec)
+    observed = []
+    for thresh in threshs:
+        print('--- threshold %.3f ---' % thresh)
+        try:
+            observed.append(_nbs_observed(z_stat, ixes, n, thresh, extent))
+        except ValueError as e:
+            # nothing survives this threshold, the sweep goes on with the others
+            print(f'no component above the threshold: {e}')
+            observed.append((np.zeros((n, n)), np.zeros((0,)), 0))
+
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = NullCheckpoint(checkpoint, hash_inputs('nbs_sweep', xs, ys, threshs, extent, block_size))
+        seed = _checkpoint_seed(ckpt, seed)
+
+    k, exact, blocks = nbs_perm_blocks(y_vec, ys, k, block_size, seed)
+    shared = (xs, ys, ixes, n, threshs, extent)
+    null_chunks = _resume_chunks(_nbs_sweep_chunk, shared, blocks, n_jobs, ckpt)
+    # the thresholds without a component have no p-value to estimate, they do not hold the
+    # others in sequential mode and keep the permutations the others needed
+    stops = [None if exact or not len(sz_links) else stop_hits for _, sz_links, _ in observed]
+    gather_stops = [0 if stop_hits is not None and not len(sz_links) else stop
+                    for (_, sz_links, _), stop in zip(observed, stops)]
+    thresh_chunks = _gather_null_chunks(null_chunks, [max_sz for _, _, max_sz in observed], gather_stops,
+                                        [len(blocks)] * len(threshs))
+
+    results = []
+    for thresh, (adj, sz_links, max_sz), chunks, stop in zip(threshs, observed, thresh_chunks, stops):
+        print('--- NBS null distribution for threshold %.3f ---' % thresh)
+        null = _nbs_collect_null(iter(chunks), k, max_sz, stop_hits=stop, verbose=verbose)
+        results.append((_nbs_pvals(null, sz_links), adj, null))
+    # the thresholds share the permutations
+    count('permutations', max(len(null) for _, _, null in results))
+
+    return results
+
+def _nbs_edge_stats(corr_arr, y_vec):
+    ''' Vectorizes the upper triangle of the matrices and standardizes the edges and the
+    external variable. Returns n, the edge indices, the standardized edges and external
+    variable, and the Fisher z of the observed correlation of each edge.'''
 
     ix, jx, nx = corr_arr.shape
     ny, = y_vec.shape
@@ -325,62 +842,109 @@ def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False):
         raise ValueError('The [y_vec dimension must match the [corr_arr] third dimension')
 
     # only consider upper triangular edges
-    ixes = np.where(np.triu(np.ones((n, n)), 1))
-
-    # number of edges
-    m = np.size(ixes, axis=1)
-
-    # vectorize connectivity matrices for speed
-    xmat = np.zeros((m, nx))
+    ixes = triu_indices(n)
 
-    for i in range(nx):
-        xmat[:, i] = corr_arr[:, :, i][ixes].squeeze()
-    del corr_arr
+    # vectorize connectivity matrices for speed, shape (n_edges, n_subjects)
+    xmat = np.asarray(corr_arr[ixes[0], ixes[1], :], dtype=float)
 
-    # perform pearson corr test at each edge
-
-    z_stat = np.apply_along_axis(corr_with_vars, 1, xmat, y_vec)
+    # perform pearson corr test at each edge, in closed form from the standardized data
+    xs = standardize_rows(xmat)
+    ys = standardize_rows(y_vec.astype(float))
+    z_stat = corr_z(xs, ys[np.newaxis, :])[:, 0]
     print('z_stat: ', z_stat)
 
+    return n, ixes, xs, ys, z_stat
+
+def _gather_null_chunks(null_chunks, max_szs, stops, n_blocks):
+    ''' Gathers the blocks of several null distributions computed together (one list per
+    distribution in each item of null_chunks, None once a distribution has no blocks left),
+    and stops early once every distribution has reached its stop_hits or its last block.'''
+
+    gathered = [[] for _ in max_szs]
+    hits = np.zeros(len(max_szs))
+    for chunks in null_chunks:
+        for i, chunk in enumerate(chunks):
+            if chunk is not None:
+                gathered[i].append(chunk)
+                hits[i] += np.sum(chunk >= max_szs[i])
+        stopped = [stop is not None and hit >= stop for stop, hit in zip(stops, hits)]
+        finished = [len(chunks) == blocks for chunks, blocks in zip(gathered, n_blocks)]
+        if all(np.logical_or(stopped, finished)):
+            # closing the generator cancels the blocks not started yet
+            null_chunks.close()
+            break
+
+    return gathered
+
+def _checkpoint_seed(ckpt, seed):
+    ''' Seed of a run resuming from ckpt: the entropy of the checkpoint if there is no seed'''
+
+    if seed is None and ckpt.entropy not in (None, 'None'):
+        return int(ckpt.entropy)
+    return seed
+
+def _block_len(block):
+    ''' Number of permutations of a block of nbs_perm_blocks'''
+
+    _, _, size, perm_ys = block
+    return size if perm_ys is None else len(perm_ys)
+
+def _resume_chunks(func, shared, blocks, n_jobs, ckpt):
+    ''' map_chunks over the blocks of nbs_perm_blocks, reading the blocks already saved in the
+    checkpoint ckpt (if not None) and saving the new ones.'''
+
+    if ckpt is None:
+        yield from map_chunks(func, shared, blocks, n_jobs=n_jobs)
+        return
+
+    ckpt.use_entropy(blocks[0][0])
+    todo = [b for b, block in enumerate(blocks) if ckpt.get(b, _block_len(block)) is None]
+    if len(todo) < len(blocks):
+        print('resuming from %i saved blocks of permutations' % (len(blocks) - len(todo)))
+    computed = map_chunks(func, shared, [blocks[b] for b in todo], n_jobs=n_jobs)
+    todo = set(todo)
+    try:
+        for b, block in enumerate(blocks):
+            if b in todo:
+                chunk = next(computed)
+                ckpt.add(b, chunk)
+            else:
+                chunk = ckpt.get(b, _block_len(block))
+            yield chunk
+    finally:
+        computed.close()
+        ckpt.save()
+
+def _nbs_observed(z_stat, ixes, n, thresh, extent):
+    ''' Components of the observed suprathreshold graph: the adjacency matrix with the edges
+    of each component numbered, the size of each component and the largest size. The size
+    of a component is its number of edges (extent) or the sum of their z values (intensity),
+    as for the permuted graphs in _max_sizes.'''
+
     # threshold
     ind_r, = np.where(z_stat > thresh)
-
     if len(ind_r) == 0:
         raise ValueError("Unsuitable threshold")
 
     # suprathreshold adjacency matrix
     adj = np.zeros((n, n))
-    adjT = np.zeros((n, n))
-
-    if extent:
-        adj[(ixes[0][ind_r], ixes[1][ind_r])] = 1
-        adj = adj + adj.T  # make symmetrical
-    else:
-        adj[(ixes[0][ind_r], ixes[1][ind_r])] = 1
-        adj = adj + adj.T  # make symmetrical
-        adjT[(ixes[0], ixes[1])] = z_stat
-        adjT = adjT + adjT.T  # make symmetrical
-        adjT[adjT <= thresh] = 0
+    adj[(ixes[0][ind_r], ixes[1][ind_r])] = 1
+    adj = adj + adj.T  # make symmetrical
 
     a, sz = get_components(adj)
 
-    # convert size from nodes to number of edges
-    # only consider components comprising more than one node (e.g. a/l 1 edge)
+    # only consider components comprising more than one node (e.g. a/l 1 edge), numbered
+    # from 1 in the order of their labels, and sum the size of their edges
     ind_sz, = np.where(sz > 1)
     ind_sz += 1
-    nr_components = np.size(ind_sz)
-    sz_links = np.zeros((nr_components,))
-    for i in range(nr_components):
-        nodes, = np.where(ind_sz[i] == a)
-        if extent:
-            sz_links[i] = np.sum(adj[np.ix_(nodes, nodes)]) / 2
-        else:
-            sz_links[i] = np.sum(adjT[np.ix_(nodes, nodes)]) / 2
-
-        adj[np.ix_(nodes, nodes)] *= (i + 2)
+    edge_comp = np.searchsorted(ind_sz, a[ixes[0][ind_r]])
+    weights = None if extent else z_stat[ind_r]
+    sz_links = np.bincount(edge_comp, weights=weights, minlength=len(ind_sz)).astype(float)
 
-    # subtract 1 to delete any edges not comprising a component
-    adj[np.where(adj)] -= 1
+    # number the edges of each component, the edges not comprising a component stay at 0
+    adj = np.zeros((n, n))
+    adj[(ixes[0][ind_r], ixes[1][ind_r])] = edge_comp + 1
+    adj = adj + adj.T
 
     if np.size(sz_links):
         max_sz = np.max(sz_links)
@@ -389,63 +953,130 @@ def nbs_bct_corr_z(corr_arr, thresh, y_vec, k=1000, extent=True, verbose=False):
         raise ValueError('True matrix is degenerate')
     print('max component size is %i' % max_sz)
 
+    return adj, sz_links, max_sz
+
+def nbs_perm_blocks(y_vec, ys, k, block_size, seed):
+    ''' Plans the blocks of permutations of the NBS null distribution: random permutations,
+    or all the distinct relabellings if there are no more than k (exact null distribution).
+
+    Returns
+    -------
+    k : int
+        number of permutations (the number of relabellings if exact)
+    exact : bool
+        True if all the relabellings are enumerated
+    blocks : list of tuple
+        (entropy, chunk, size, perm_ys) of each block, see _draw_perm_ys
+    '''
+
+    if n_relabellings(y_vec) <= k:
+        # few distinct relabellings: the exact null distribution is cheaper than sampling
+        perm_ys = unique_relabellings(ys)
+        k = len(perm_ys)
+        print('exact null distribution over all %i relabellings' % k)
+        return k, True, [(None, None, None, perm_ys[start:start + block_size])
+                         for start in range(0, k, block_size)]
+
     # estimate empirical null distribution of maximum component size by
     # generating k independent permutations
     print('estimating null distribution with %i permutations' % k)
+    # every block of permutations gets an independent random stream derived from the seed
+    entropy = np.random.SeedSequence(seed).entropy
+    return k, False, [(entropy, start // block_size, min(block_size, k - start), None)
+                      for start in range(0, k, block_size)]
+
+def _nbs_collect_null(null_chunks, k, max_sz, stop_hits=None, verbose=False):
+    ''' Gathers the blocks of the null distribution of maximal component size, printing the
+    progress, and stops early once stop_hits permutation maxima reach max_sz.'''
 
     null = np.zeros((k,))
     hit = 0
+    stopped = False
+    start = 0
+
+    for null_chunk in null_chunks:
+        size = len(null_chunk)
+        null[start:start + size] = null_chunk
+
+        for u in range(start, start + size):
+            # compare to the true dataset
+            if null[u] >= max_sz:
+                hit += 1
+            if verbose:
+                print('permutation %i of %i.  Permutation max is %s.  Observed max'
+                      ' is %s.  P-val estimate is %.3f' % (
+                    u, k, null[u], max_sz, hit / (u + 1)))
+            elif (u % (k / 10) == 0 or u == k - 1):
+                print('permutation %i of %i.  p-value so far is %.3f' % (u, k,
+                                                                         hit / (u + 1)))
+            if stop_hits is not None and hit >= stop_hits:
+                stopped = True
+                break
+
+        if stopped:
+            # closing the generator cancels the blocks not started yet
+            if hasattr(null_chunks, 'close'):
+                null_chunks.close()
+            null = null[:u + 1]
+            print('stopped after %i permutations, p-value is %.3f' % (u + 1, hit / (u + 1)))
+            break
+        start += size
+    else:
+        # fewer blocks than planned if the distributions computed with this one stopped first
+        null = null[:start]
+
+    return null
 
-    ind_shuff1 = np.array(range(0, y_vec.__len__()))
-    ind_shuff2 = np.array(range(0, y_vec.__len__()))
+def _nbs_pvals(null, sz_links):
+    ''' Corrected p-value of each observed component from the null distribution.'''
 
-    for u in range(k):
-        # randomize
-        np.random.shuffle(ind_shuff1)
-        np.random.shuffle(ind_shuff2)
-        # perform pearson corr test at each edge
-        z_stat_perm = np.apply_along_axis(corr_with_vars, 1, xmat, y_vec[ind_shuff1])
+    pvals = np.zeros((len(sz_links),))
+    # calculate p-vals
+    for i in range(len(sz_links)):
+        pvals[i] = np.size(np.where(null >= sz_links[i])) / len(null)
 
-        ind_r, = np.where(z_stat_perm > thresh)
+    return pvals
 
-        adj_perm = np.zeros((n, n))
+def chunk_rng(entropy, chunk):
+    ''' Random generator of one block of permutations, independent of how the blocks are
+    distributed across processes.'''
 
-        if extent:
-            adj_perm[(ixes[0][ind_r], ixes[1][ind_r])] = 1
-            adj_perm = adj_perm + adj_perm.T
-        else:
-            adj_perm[(ixes[0], ixes[1])] = z_stat_perm
-            adj_perm = adj_perm + adj_perm.T
-            adj_perm[adj_perm <= thresh] = 0
-
-        a, sz = get_components(adj_perm)
-
-        ind_sz, = np.where(sz > 1)
-        ind_sz += 1
-        nr_components_perm = np.size(ind_sz)
-        sz_links_perm = np.zeros((nr_components_perm))
-        for i in range(nr_components_perm):
-            nodes, = np.where(ind_sz[i] == a)
-            sz_links_perm[i] = np.sum(adj_perm[np.ix_(nodes, nodes)]) / 2
-
-        if np.size(sz_links_perm):
-            null[u] = np.max(sz_links_perm)
-        else:
-            null[u] = 0
-
-        # compare to the true dataset
-        if null[u] >= max_sz:
-            hit += 1
-        if verbose:
-            print('permutation %i of %i.  Permutation max is %s.  Observed max'
-                  ' is %s.  P-val estimate is %.3f') % (
-                u, k, null[u], max_sz, hit / (u + 1))
-        elif (u % (k / 10) == 0 or u == k - 1):
-            print('permutation %i of %i.  p-value so far is %.3f' % (u, k,
-                                                                     hit / (u + 1)))
-    pvals = np.zeros((nr_components,))
-    # calculate p-vals
-    for i in range(nr_components):
-        pvals[i] = np.size(np.where(null >= sz_links[i])) / k
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(chunk,)))
+
+def _draw_perm_ys(ys, entropy, chunk, size, perm_ys):
+    ''' Permuted external variables of one block of nbs_perm_blocks, shape (size, n_subjects):
+    perm_ys itself for an exact block, else drawn from the stream of the block.'''
+
+    if perm_ys is not None:
+        return perm_ys
+
+    rng = chunk_rng(entropy, chunk)
+    # randomize the subjects for the whole block
+    perm_idx = rng.permuted(np.tile(np.arange(len(ys)), (size, 1)), axis=1)
+
+    return ys[perm_idx]
+
+def _nbs_null_chunk(xs, ys, ixes, n, thresh, extent, entropy, chunk, size, perm_ys):
+    ''' Maximal component sizes of one block of NBS permutations.'''
+
+    # perform pearson corr test at each edge for the whole block
+    z_block = corr_z(xs, _draw_perm_ys(ys, entropy, chunk, size, perm_ys))
+
+    return _max_sizes(z_block, ixes, n, thresh, extent)
+
+def _nbs_sweep_chunk(xs, ys, ixes, n, threshs, extent, entropy, chunk, size, perm_ys):
+    ''' Maximal component sizes of one block of NBS permutations for each threshold.'''
+
+    z_block = corr_z(xs, _draw_perm_ys(ys, entropy, chunk, size, perm_ys))
+
+    # the graphs of all the thresholds are labelled in one pass
+    supra = np.concatenate([z_block.T > thresh for thresh in threshs])
+    weights = None if extent else np.tile(z_block.T, (len(threshs), 1))
+    return max_component_sizes(supra, ixes, n, weights=weights).reshape(len(threshs), -1)
+
+def _max_sizes(z_block, ixes, n, thresh, extent):
+    ''' Maximal component size of the suprathreshold graph of each column of z_block: its
+    number of edges (extent) or the sum of their z values (intensity).'''
 
-    return pvals, adj, null
\ No newline at end of file
+    weights = None if extent else z_block.T
+    return max_component_sizes(z_block.T > thresh, ixes, n, weights=weights)
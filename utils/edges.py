@@ -0,0 +1,73 @@
+from functools import lru_cache
+import numpy as np
+
+# Indices of the edges (unique off-diagonal coordinates) of connectivity matrices, computed
+# once per number of nodes. The arrays are shared between the callers, they are read-only.
+
+def _read_only(*arrays):
+    for arr in arrays:
+        arr.flags.writeable = False
+
+    return arrays
+
+@lru_cache(maxsize=None)
+def tril_indices(n_nodes):
+    ''' Row and column indices of the lower triangle of a (n_nodes, n_nodes) matrix, without the
+    diagonal, as np.tril_indices(n_nodes, k=-1). The order of the edge vectors of the t-test and
+    the permutation test.'''
+
+    return _read_only(*np.tril_indices(n_nodes, k=-1))
+
+@lru_cache(maxsize=None)
+def triu_indices(n_nodes):
+    ''' Row and column indices of the upper triangle of a (n_nodes, n_nodes) matrix, without the
+    diagonal, as np.triu_indices(n_nodes, k=1). The order of the edge vectors of the NBS.'''
+
+    return _read_only(*np.triu_indices(n_nodes, k=1))
+
+@lru_cache(maxsize=None)
+def tril_scatter(n_nodes):
+    ''' Flat indices of the lower triangle of a (n_nodes, n_nodes) matrix and of their mirror in
+    the upper triangle: mat.flat[lower] gathers an edge vector, setting mat.flat[lower] and
+    mat.flat[upper] scatters it back to a symmetric matrix.'''
+
+    rows, cols = tril_indices(n_nodes)
+
+    return _read_only(rows * n_nodes + cols, cols * n_nodes + rows)
+
+def n_edges(n_nodes):
+    ''' Number of edges of a (n_nodes, n_nodes) connectivity matrix'''
+
+    return n_nodes * (n_nodes - 1) // 2
+
+def n_nodes(n_edges):
+    ''' Number of nodes of a connectivity matrix with n_edges edges'''
+
+    n = int(round((1 + np.sqrt(1 + 8 * n_edges)) / 2))
+    if n * (n - 1) // 2 != n_edges:
+        raise ValueError(f'{n_edges} values are not the edges of a connectivity matrix')
+
+    return n
+
+def mat2vec(mats):
+    ''' Edge vector of the lower triangle of a matrix, or of each matrix of a stack
+    (..., n_nodes, n_nodes) -> (..., n_edges)'''
+
+    lower, _ = tril_scatter(mats.shape[-1])
+
+    return mats.reshape(*mats.shape[:-2], -1)[..., lower]
+
+def vec2mat(vecs, diag=1):
+    ''' Symmetric matrix of an edge vector of the lower triangle, or of each vector of a stack
+    (..., n_edges) -> (..., n_nodes, n_nodes). The number of nodes is taken from the
+    number of edges.'''
+
+    vecs = np.asarray(vecs)
+    n = n_nodes(vecs.shape[-1])
+    lower, upper = tril_scatter(n)
+    mats = np.zeros((*vecs.shape[:-1], n * n))
+    mats[..., lower] = vecs
+    mats[..., upper] = vecs
+    mats[..., ::n + 1] = diag
+
+    return mats.reshape(*vecs.shape[:-1], n, n)
@@ -0,0 +1,41 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+_SHARED = None
+
+def _init_worker(shared):
+    global _SHARED
+    _SHARED = shared
+
+def _run_chunk(func, task):
+    return func(*_SHARED, *task)
+
+def map_chunks(func, shared, tasks, n_jobs=1):
+    ''' Lazily computes func(*shared, *task) for each task, in order, on n_jobs processes.
+    The shared arguments are sent once to each worker instead of once per task.
+    Closing the generator early cancels the tasks not started yet.
+
+    Parameters
+    ----------
+    func : callable
+        Module-level function (it has to be picklable).
+    shared : tuple
+        Arguments common to all the tasks.
+    tasks : list of tuple
+        Task-specific arguments.
+    n_jobs : int
+        Number of processes, -1 for all the CPUs. Default is 1 (no pool).
+    '''
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, len(tasks))
+
+    if n_jobs <= 1:
+        for task in tasks:
+            yield func(*shared, *task)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(shared,)) as executor:
+        yield from executor.map(_run_chunk, [func] * len(tasks), tasks)
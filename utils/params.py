@@ -3,6 +3,29 @@ from itertools import combinations
 groups = ['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO']
 comparisons = list(combinations(groups, 2))
 
+# record the wall/CPU time, memory and I/O of each step in derivative/trace/ (see utils/trace.py)
+trace = False
+
+# permutations: seed of the random streams and number of processes (-1 = all CPUs)
+seed = 42
+n_jobs = -1
+# CPU budget of pipeline.py, shared by the stages running at the same time (-1 = all CPUs)
+pipeline_cpus = -1
+# sequential permutations (Besag-Clifford): stop an edge / an NBS comparison once this many
+# permuted statistics are at least as extreme as the observed one. None runs all of them.
+stop_hits = None
+# permutation test: statistic of each edge ('mean_diff' or 'welch') and multiple comparisons
+# correction ('fdr_bh', or 'maxT' for the family-wise error rate; not with stop_hits)
+perm_statistic = 'mean_diff'
+perm_correction = 'fdr_bh'
+
+# NBS: threshold on the Fisher z of the edges, and the thresholds of the sensitivity analysis
+# (all from one pass of permutations per comparison; None to skip it)
+nbs_thresh = 0.15
+nbs_k = 1000 # permutations; raising it extends the checkpointed null distributions
+nbs_extent = True # component size: number of edges (True) or sum of their z values (False)
+nbs_sweep_threshs = None
+
 # ROIs acronyms
 acronyms = ['RSplen-L', 'RSplen-R', 'Vis-L', 'Vis-R', 'PPAssoc-L', 'PPAssoc-R', 'Audit-L',
         'Audit-R', 'TAssoc-L', 'TAssoc-R', 'EC-L', 'EC-R', 'Olf-L', 'Olf-R', 'DG-L',
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from utils.cache import ArtifactCache, hash_inputs
+from utils.preproc import file_signature
+from utils.trace import start_trace, stop_trace
+
+STAMP_DIR = 'derivative/.pipeline'
+
+class Stage:
+    ''' A step of the pipeline.
+
+    Attributes
+    ----------
+    name : str
+        Name of the stage
+    func : callable
+        Function running the stage, called without arguments, or with n_jobs if the stage
+        is parallel
+    deps : list of str
+        Stages that have to be done before this one
+    inputs : list of str
+        Files the stage reads
+    outputs : list of str
+        Directories the stage writes to. The stage is run again if a file in them was
+        removed or modified since the last run.
+    params : dict
+        Parameters that change the outputs of the stage. With the inputs, they define when
+        the stage is up to date.
+    parallel : bool
+        If True, the stage runs on as many processes as the CPU budget allows (n_jobs),
+        otherwise it uses one CPU
+    in_process : bool
+        If True, the stage runs in the process of the pipeline (e.g. to load data shared
+        with the following stages) and is never skipped. Default is False.
+    '''
+
+    def __init__(self, name, func, deps=(), inputs=(), outputs=(), params=None, parallel=False,
+                 in_process=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.parallel = parallel
+        self.in_process = in_process
+
+    def stamp_path(self):
+        return os.path.join(STAMP_DIR, f'{self.name}.json')
+
+    def key(self, known=None):
+        ''' Hash of the params and of the content of the inputs of the stage. The inputs whose
+        size and modification time are those of known (a record from a previous run) are
+        not hashed again.'''
+
+        known = known or {}
+        signatures = {path: file_signature(path, known.get(path)) for path in self.inputs}
+
+        return hash_inputs(self.name, self.params, {path: sig and sig['sha256'] for path, sig in signatures.items()}), \
+            signatures
+
+    def listing(self):
+        ''' Size and modification time of every file in the outputs of the stage'''
+
+        files = {}
+        for outdir in self.outputs:
+            for root, _, fnames in os.walk(outdir):
+                for fname in fnames:
+                    if not fname.endswith('.tmp'):
+                        stat = os.stat(os.path.join(root, fname))
+                        files[os.path.join(root, fname)] = [stat.st_size, stat.st_mtime_ns]
+
+        return files
+
+
+def _stamp(stage):
+    try:
+        with open(stage.stamp_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def stage_fresh(stage, cache):
+    ''' True if the stage ran with the same params and inputs and its outputs did not change since'''
+
+    stamp = _stamp(stage)
+    if stamp is None:
+        return False
+    key, _ = stage.key(stamp.get('inputs'))
+
+    return cache.fresh(stage.stamp_path(), key) and stamp.get('outputs') == stage.listing()
+
+def record_stage(stage, cache):
+    ''' Records that the stage is done, with the signature of its inputs and the listing of
+    its outputs'''
+
+    os.makedirs(STAMP_DIR, exist_ok=True)
+    stamp = _stamp(stage) or {}
+    key, signatures = stage.key(stamp.get('inputs'))
+    with open(stage.stamp_path(), 'w') as f:
+        json.dump({'inputs': signatures, 'outputs': stage.listing()}, f)
+    cache.record(stage.stamp_path(), key)
+
+def _run_stage(stage, n_jobs):
+    ''' Runs a stage in its own process, with its own trace'''
+
+    start_trace(f'pipeline_{stage.name}')
+    try:
+        if stage.parallel:
+            stage.func(n_jobs=n_jobs)
+        else:
+            stage.func()
+    finally:
+        stop_trace()
+
+def _allot(ready, free):
+    ''' CPUs given to the ready stages, served in the order of the stages (by decreasing
+    priority): each one gets a CPU while there are CPUs left, then the CPUs left once every
+    ready stage has one are shared by the parallel stages, the first ones getting the larger
+    shares. The CPUs of a stage are set when it starts, those it frees go to the stages
+    started afterwards.'''
+
+    allotted = {stage.name: 1 for stage in ready[:max(free, 0)]}
+    left = free - len(allotted)
+    parallel = [stage for stage in ready if stage.parallel and stage.name in allotted]
+    for i, stage in enumerate(parallel):
+        share = -(-left // (len(parallel) - i)) # rounded up, for the first stages
+        allotted[stage.name] += share
+        left -= share
+
+    return allotted
+
+def run_stages(stages, cpus=-1, force=False, cache=None):
+    ''' Runs the stages of a pipeline in the order of their dependencies. The stages that do
+    not depend on each other run at the same time in separate processes, within a budget of
+    cpus CPUs. On Linux the processes are forked, so the data loaded by the in-process stages
+    (e.g. the cohort) is shared with them without being loaded again. Elsewhere they are
+    spawned (forking is unsafe on macOS once the system frameworks are loaded), the functions
+    of the stages must then be picklable and each stage reopens the memory-mapped cohort store.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        The stages, by decreasing priority (the first ones get the CPUs first)
+    cpus : int
+        CPU budget, -1 for all the CPUs. Default is -1.
+    force : bool
+        If True, runs the stages even if they are up to date. Default is False.
+    cache : ArtifactCache | None
+        Cache of the stage records, default is a new ArtifactCache
+
+    Returns
+    -------
+    status : dict
+        For each stage, 'done', 'up to date', 'failed' or 'not run' (a dependency failed)
+    '''
+
+    if cpus == -1:
+        cpus = os.cpu_count()
+    cpus = max(cpus, 1)
+    cache = cache or ArtifactCache()
+    fork = sys.platform != 'darwin' and 'fork' in multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if fork else 'spawn')
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in names]
+        if missing:
+            raise ValueError(f'Stage {stage.name} depends on unknown stages {missing}')
+
+    status = {}
+    pending = list(stages)
+    running = {} # sentinel -> (stage, process, n_cpus, start)
+    t0 = time.perf_counter()
+    while pending or running:
+        ready = []
+        for stage in list(pending):
+            deps = [status.get(dep) for dep in stage.deps]
+            if any(dep in ('failed', 'not run') for dep in deps):
+                status[stage.name] = 'not run'
+                pending.remove(stage)
+                print(f'[pipeline] {stage.name} not run: a dependency failed')
+            elif all(dep in ('done', 'up to date') for dep in deps):
+                ready.append(stage)
+
+        for stage in ready:
+            if stage.in_process:
+                pending.remove(stage)
+                print(f'[pipeline] {stage.name} started')
+                start = time.perf_counter()
+                try:
+                    stage.func()
+                    status[stage.name] = 'done'
+                    print(f'[pipeline] {stage.name} done in {time.perf_counter() - start:.1f} s')
+                except Exception as e:
+                    status[stage.name] = 'failed'
+                    print(f'[pipeline] {stage.name} failed: {type(e).__name__}: {e}')
+                break # the dependencies of the other stages may have changed
+        else:
+            fresh = [stage for stage in ready if not force and stage_fresh(stage, cache)]
+            for stage in fresh:
+                pending.remove(stage)
+                status[stage.name] = 'up to date'
+                print(f'[pipeline] {stage.name} is up to date')
+            ready = [stage for stage in ready if stage not in fresh]
+            if fresh:
+                continue # their dependents may be ready now
+
+            used = sum(n_cpus for _, _, n_cpus, _ in running.values())
+            allotted = _allot(ready, cpus - used)
+            for stage in ready:
+                if stage.name not in allotted:
+                    continue
+                n_cpus = allotted[stage.name]
+                process = context.Process(target=_run_stage, args=(stage, n_cpus), name=stage.name)
+                process.start()
+                pending.remove(stage)
+                running[process.sentinel] = (stage, process, n_cpus, time.perf_counter())
+                print(f'[pipeline] {stage.name} started on {n_cpus} CPU{"s" if n_cpus > 1 else ""}')
+
+            if running:
+                for sentinel in wait(list(running)):
+                    stage, process, _, start = running.pop(sentinel)
+                    process.join()
+                    if process.exitcode == 0:
+                        record_stage(stage, cache)
+                        status[stage.name] = 'done'
+                        print(f'[pipeline] {stage.name} done in {time.perf_counter() - start:.1f} s')
+                    else:
+                        status[stage.name] = 'failed'
+                        print(f'[pipeline] {stage.name} failed (exit code {process.exitcode})')
+            elif pending and not ready:
+                raise ValueError(f'Stages {[stage.name for stage in pending]} have circular dependencies')
+
+    print(f'[pipeline] finished in {time.perf_counter() - t0:.1f} s: ' +
+          ', '.join(f'{name} {state}' for name, state in status.items()))
+
+    return status
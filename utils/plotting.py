@@ -1,30 +1,26 @@
+import time
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import ListedColormap, Normalize
 import seaborn as sns
 from utils.preproc import *
 from utils.params import acronyms as ac
+from utils.parallel import map_chunks
+from utils.cache import hash_inputs
+from utils.trace import traced
 
 def plot_diff_group_mat(pop1, pop2, females=False):
     ''' Plots the difference between the average connectivity matrices of two groups'''
 
-    title = f'average difference of {pop1} - {pop2}'
-    if females:
-        title = f'average difference of {pop1} - {pop2} (females)'
-
-    mat_list1 = get_grp_mat(pop1, females=females, z=True)
-    mat_list2 = get_grp_mat(pop2, females=females, z=True)
-
-    def get_av(mat_list):
-        stack = np.stack((mat_list), axis=-1)
-        av = np.mean(stack, axis=-1)
-        return av
-
-    diff = get_av(mat_list1) - get_av(mat_list2)
-    fig = plot_mat(diff, title, vmin=None, vmax=None)
+    diff, title, _, vmin, vmax, _ = diff_group_job(pop1, pop2, females=females)
+    fig = plot_mat(diff, title, vmin=vmin, vmax=vmax)
 
     return fig
 
+@traced
 def plot_grp_box(df):
     ''' Plots a boxplot of the average connectivity values of each group'''
 
@@ -42,6 +38,7 @@ def plot_grp_box(df):
 
     return fig
 
+@traced
 def plot_sexdiff_box(df):
     ''' Plots a boxplot of the average connectivity values of each group, and shows the difference
     between males and females'''
@@ -59,6 +56,7 @@ def plot_sexdiff_box(df):
 
     return fig
 
+@traced
 def plot_female_box(df):
     ''' Plots a boxplot of the average connectivity values of each group, with only 
     the females'''
@@ -85,13 +83,23 @@ def plot_female_box(df):
 def plot_sgl_mat(id, title, fout):
     ''' Plots the matrix of a single animal'''
  
-    data = get_single_mat(id, z=True)
-    fig = plot_mat(data, title, vmin=None, vmax=None)
-    fig.savefig(fout)
+    render_mat(*sgl_mat_job(id, title, fout))
 
 def plot_grp_mat(pop, females=False, z=False):
     ''' Plots the average matrix of a group'''
 
+    render_mat(*grp_mat_job(pop, females=females, z=z))
+
+def sgl_mat_job(id, title, fout):
+    ''' Figure job (data, title, fout, vmin, vmax, dpi) of the matrix of a single animal'''
+
+    data = get_single_mat(id, z=True)
+
+    return data, title, fout, None, None, None
+
+def grp_mat_job(pop, females=False, z=False):
+    ''' Figure job (data, title, fout, vmin, vmax, dpi) of the average matrix of a group'''
+
     # define paths and title depending on args. 
     path_map = {
         (False, True): ('raw mean connectivity - {pop} - females', 'derivative/average/raw/females_{pop}.png'),
@@ -106,27 +114,140 @@ def plot_grp_mat(pop, females=False, z=False):
         fout = fout_template.format(pop=pop)
 
     if not z:
-        mat_list = get_grp_mat(pop, females=females, z=False)
         vmin, vmax = (-1, 1)
     elif z:
-        mat_list = get_grp_mat(pop, females=females, z=True)
         vmin, vmax = (None, None)
-    
-    stack = np.stack((mat_list), axis=-1)
-    vals = np.mean(stack, axis=-1)
-    fig = plot_mat(vals,title, vmin=vmin, vmax=vmax)
-    fig.savefig(fout, dpi=300)
+    vals = get_av_grp_mat(pop, females=females, z=z)
+
+    return vals, title, fout, vmin, vmax, 300
+
+def diff_group_job(pop1, pop2, females=False):
+    ''' Figure job (data, title, fout, vmin, vmax, dpi) of the difference between the average 
+    z-scored matrices of two groups'''
 
+    title = f'average difference of {pop1} - {pop2}'
+    fout = f'derivative/average/diff/{pop1}_{pop2}.png'
+    if females:
+        title = f'average difference of {pop1} - {pop2} (females)'
+        fout = f'derivative/average/diff/females_{pop1}_{pop2}.png'
+
+    diff = get_av_grp_mat(pop1, females=females, z=True) - get_av_grp_mat(pop2, females=females, z=True)
+
+    return diff, title, fout, None, None, 300
+
+@traced
+def render_mat(data, title, fout, vmin=-1, vmax=1, dpi=None):
+    ''' Plots a matrix and saves the figure to fout'''
+
+    fig = plot_mat(data, title, vmin=vmin, vmax=vmax)
+    fig.savefig(fout, dpi=dpi)
+
+def _render_job(data, title, fout, vmin, vmax, dpi):
+    if plt.get_backend().lower() != 'agg':
+        plt.switch_backend('Agg')
+    render_mat(data, title, fout, vmin=vmin, vmax=vmax, dpi=dpi)
+
+    return fout
+
+@traced
+def render_jobs(jobs, n_jobs=-1, cache=None):
+    ''' Renders figure jobs on n_jobs processes, with the Agg backend.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        The (data, title, fout, vmin, vmax, dpi) of each figure. The data is computed 
+        beforehand, the workers only draw and save it.
+    n_jobs : int
+        Number of processes, -1 for all the CPUs. Default is -1.
+    cache : ArtifactCache | None
+        If given, the figures already rendered from the same data and parameters are skipped.
+    '''
+
+    keys = [hash_inputs(data, title, vmin, vmax, dpi) for data, title, _, vmin, vmax, dpi in jobs]
+    if cache is not None:
+        todo = [(job, key) for job, key in zip(jobs, keys) if not cache.fresh(job[2], key)]
+    else:
+        todo = list(zip(jobs, keys))
+
+    t0 = time.perf_counter()
+    for (_, key), fout in zip(todo, map_chunks(_render_job, (), [job for job, _ in todo], n_jobs=n_jobs)):
+        if cache is not None:
+            cache.record(fout, key)
+    elapsed = time.perf_counter() - t0
+    print(f'{len(todo)} figures rendered in {elapsed:.1f} s ({len(todo) / max(elapsed, 1e-9):.2f} figures/s), '
+          f'{len(jobs) - len(todo)} up to date')
 
 def plot_mat(data, title, vmin=-1, vmax=1): 
-    ''' Plots a matrix'''
-    
-    fig, ax = plt.subplots(figsize=(7.5, 6))
-    sns.heatmap(data, ax=ax, cmap='coolwarm', center=0,
-                xticklabels=ac, yticklabels=ac,
-                vmin=vmin, vmax=vmax)
-    ax.set_title(title)
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right')
-    plt.tight_layout()
-    
-    return fig
+    ''' Plots a matrix. The figure is reused by the next call with the same shape and 
+    vmin/vmax (see MatRenderer), so it should be saved before plotting another matrix.'''
+
+    return _renderer.render(data, title, vmin=vmin, vmax=vmax)
+
+
+class MatRenderer:
+    ''' Heatmap renderer that builds the figure, axes, colorbar and tick layout once per style
+    (matrix shape, vmin, vmax). Rendering a new matrix in an existing style only updates the 
+    image data (and color range, if it depends on the data) and the title.
+
+    The first matrix of each style is drawn with sns.heatmap, so the figures look the same as
+    a heatmap drawn from scratch.
+    '''
+
+    def __init__(self):
+        self._styles = {}
+
+    def render(self, data, title, vmin=-1, vmax=1):
+        ''' Draws a matrix and returns the (reused) figure'''
+
+        key = (data.shape, vmin, vmax)
+        if key not in self._styles:
+            self._styles[key] = self._build(data, title, vmin, vmax)
+            return self._styles[key][0]
+
+        fig, ax, mesh = self._styles[key]
+        plot_data = np.ma.masked_invalid(data)
+        mesh.set_array(plot_data)
+        if vmin is None or vmax is None:
+            # the color range follows the data, recenter the colormap as sns.heatmap does
+            cmin = np.nanmin(data) if vmin is None else vmin
+            cmax = np.nanmax(data) if vmax is None else vmax
+            mesh.set_cmap(self._centered_cmap(cmin, cmax))
+            mesh.set_clim(cmin, cmax)
+        ax.set_title(title)
+        if vmin is None or vmax is None:
+            fig.tight_layout() # the colorbar tick labels may have changed width
+
+        return fig
+
+    def _build(self, data, title, vmin, vmax):
+
+        fig = Figure(figsize=(7.5, 6))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        # the ROI acronyms if the matrix is of the default atlas, else the node numbers
+        labels = ac if len(data) == len(ac) else 'auto'
+        sns.heatmap(data, ax=ax, cmap='coolwarm', center=0,
+                    xticklabels=labels, yticklabels=labels,
+                    vmin=vmin, vmax=vmax)
+        ax.set_title(title)
+        ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right')
+        fig.tight_layout()
+
+        return fig, ax, ax.collections[0]
+
+    @staticmethod
+    def _centered_cmap(vmin, vmax, center=0):
+        ''' The coolwarm colormap, cropped to [vmin, vmax] around center like sns.heatmap does'''
+
+        cmap = plt.get_cmap('coolwarm')
+        bad = cmap(np.ma.masked_invalid([np.nan]))[0]
+        vrange = max(vmax - center, center - vmin)
+        cmin, cmax = Normalize(center - vrange, center + vrange)([vmin, vmax])
+        centered = ListedColormap(cmap(np.linspace(cmin, cmax, 256)))
+        centered.set_bad(bad)
+
+        return centered
+
+
+_renderer = MatRenderer()
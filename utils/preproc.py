@@ -2,34 +2,161 @@ import pandas as pd
 import numpy as np
 import os
 import glob
-
-def pre_run_check():
+import json
+import hashlib
+from utils.parallel import map_chunks
+from utils.trace import traced
+from utils.edges import mat2vec, vec2mat, n_nodes
+
+# binary store of the whole cohort, see cohort_store()
+STORE_PATH = 'data/cohort.npy'
+STORE_INDEX_PATH = 'data/cohort_index.csv'
+# animal id -> group and .csv paths, see build_file_index()
+FILE_INDEX_PATH = 'data/file_index.csv'
+# signatures of the preprocessed source files, see pre_run_check()
+MANIFEST_PATH = 'data/manifest.json'
+DESC_PATH = 'data/code_animaux.xlsx'
+
+# group names of code_animaux.xlsx -> names of the group directories
+GROUP_NAMES = {
+    'C57BL/6J': 'WT',
+    '3xTg-AD': '3xTgAD',
+    'Tspo KO': 'TSPO_KO',
+    '3xTg-AD-TSPO': '3xTgAD_TSPO_KO',
+}
+
+@traced
+def pre_run_check(n_jobs=-1):
     ''' Check if the data is available and preprocessed. If not, preprocess the data.
     Also ensures that the directory tree for the results is created.
-    Should be run before any analysis script.'''
+    Should be run before any analysis script.
+
+    Preprocessing is incremental: the manifest (data/manifest.json) records the hash of every
+    source file, so only new or modified animals are converted, z-scored and added to the
+    dataframe and the cohort store, and the animals whose .txt was deleted or that were
+    removed from code_animaux.xlsx are dropped from them. New .txt files are ingested on
+    n_jobs processes.'''
+
+    global _cohort
+    _cohort = None # the data may change, reload the cohort on next access
 
     check_tree()
-    if not len(glob.glob('data/*/*souris*.csv')) == 0:
+    mats = {}
+    manifest = load_manifest()
+    removed_ids = drop_removed_sources(manifest)
+    changed = changed_sources(manifest)
+    changed_ids = [txt_animal_id(fname) for _, fname in changed] + removed_ids
+    if len(changed) == 0:
         print('Data already preprocessed')
     else:
         try:
-            txt_csv()
-            print('Successfully transformed .txt to .csv')
+            mats = ingest(changed, n_jobs=n_jobs)
+            print(f'Successfully transformed and z-scored {len(changed)} new or modified .txt')
+            for _, fname in changed:
+                manifest[fname] = file_signature(fname)
         except:
-            print('Could not transform .txt to .csv, some analyses may not work')
-    if not len(glob.glob('data/*/*souris*zscore.csv')) == 0:
-        print('Data already z-scored')
-    else:
+            print('Could not preprocess the new .txt files, some analyses may not work')
+    if file_index_outdated():
+        build_file_index()
+    known = manifest.get(DESC_PATH)
+    desc_signature = file_signature(DESC_PATH, known)
+    full_df = not os.path.exists('data/all_df.csv')
+    if not full_df and desc_signature is not None:
+        if known is None and os.path.getmtime('data/all_df.csv') >= desc_signature['mtime']:
+            manifest[DESC_PATH] = desc_signature # dataframe created before the manifest existed
+        elif known is None or desc_signature['sha256'] != known['sha256']:
+            # only the animals added to, modified in or removed from the description need to be processed
+            changed_ids = sorted(set(changed_ids) | set(desc_changed_ids()))
+    if full_df or len(changed_ids) > 0:
         try:
-            zscore_mat()
-            print('Successfully z-scored the matrices')
+            all_df(ids=None if full_df else changed_ids, mats=mats)
+            manifest[DESC_PATH] = desc_signature
         except:
-            print('Could not z-score the data, some analyses may not work')
-    if not os.path.exists('data/all_df.csv'):
+            print('Could not create the dataframe with the average connectivity values, some analyses may not work')
+    elif desc_signature is not None:
+        manifest[DESC_PATH] = desc_signature # no animal to update, the description is up to date
+    if store_outdated():
         try:
-            all_df()
+            cohort_store(ids=None if full_df else changed_ids, mats=mats)
         except:
-            print('Could not create the dataframe with the average connectivity values, some analyses may not work')
+            print('Could not create the binary cohort store, matrices will be loaded from the .csv files')
+    save_manifest(manifest)
+
+def load_manifest():
+    ''' Load the preprocessing manifest {source path: signature}'''
+
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def file_signature(path, known=None):
+    ''' Size, modification time and sha256 of a file (None if it does not exist). If the size and
+    mtime match the known signature, the file is not hashed again.'''
+
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return known
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': h.hexdigest()}
+
+def changed_sources(manifest, groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO']):
+    ''' List the (group, .txt path) of the animals that are new or whose .txt changed since they 
+    were preprocessed. Files preprocessed before the manifest existed are adopted if their
+    outputs are newer than them.'''
+
+    changed = []
+    for pop in groups:
+        for fname in sorted(glob.glob(f'data/{pop}/*.txt')):
+            known = manifest.get(fname)
+            signature = file_signature(fname, known)
+            animal_id = txt_animal_id(fname)
+            outputs = [f'data/{pop}/souris_{animal_id}.csv', f'data/{pop}/souris_{animal_id}_zscore.csv']
+            done = all(os.path.exists(out) for out in outputs)
+            if known is None and done and \
+                    all(os.path.getmtime(out) >= signature['mtime'] for out in outputs):
+                manifest[fname] = signature
+            elif not done or known is None or signature['sha256'] != known['sha256']:
+                changed.append((pop, fname))
+            else:
+                manifest[fname] = signature # same content, refresh the mtime
+
+    return changed
+
+def drop_removed_sources(manifest):
+    ''' Delete the .csv matrices of the animals whose .txt was deleted since it was
+    preprocessed and forget the .txt in the manifest. Returns the ids of these animals, to be
+    dropped from the dataframe and the cohort store.'''
+
+    removed_ids = []
+    for fname in sorted(manifest):
+        if fname == DESC_PATH or os.path.exists(fname):
+            continue
+        pop = os.path.basename(os.path.dirname(fname))
+        animal_id = txt_animal_id(fname)
+        for out in (f'data/{pop}/souris_{animal_id}.csv', f'data/{pop}/souris_{animal_id}_zscore.csv'):
+            if os.path.exists(out):
+                os.remove(out)
+        del manifest[fname]
+        removed_ids.append(animal_id)
+        print(f'{fname} was deleted, animal {animal_id} is removed from the preprocessed data')
+
+    return removed_ids
+
+def txt_animal_id(fname):
+    ''' Id of an animal from the name of its .txt file'''
+
+    return fname.split('Souris')[1].split('_')[1]
 
 def check_tree():
     ''' Create the directory tree for the results (derivative)'''
@@ -42,12 +169,14 @@ def check_tree():
             'derivative/nbs/pvals',
             'derivative/nbs/adjacency',
             'derivative/nbs/figures',
+            'derivative/nbs/sweep',
             'derivative/ttest/figures/raw_pvals',
             'derivative/ttest/pvals',
             'derivative/ttest/pvals/raw_pvals',
             'derivative/permutations/figures/raw_pvals',
             'derivative/permutations/pvals',
             'derivative/permutations/pvals/raw_pvals',
+            'derivative/permutations/n_perms',
             'derivative/anova',
             'derivative/individuals/',
     ]
@@ -58,24 +187,280 @@ def check_tree():
             print(f'{path} was created')
     
 def get_single_mat(id, z=False):
+    ''' Load the matrix of a single animal from its .csv file'''
 
-    # not used yet
-    if z:
-        path = glob.glob(f'data/*/souris_{id}_zscore.csv')[0]
-    else:
-        path = glob.glob(f'data/*/souris_{id}.csv')[0]
-    data = pd.read_csv(path, index_col=0)
+    data = pd.read_csv(mat_path(id, z=z), index_col=0)
 
     return data.values
 
+def mat_path(id, z=False):
+    ''' Path of the .csv file of an animal, looked up in the file index'''
 
-def get_av_grp_mat(pop, females=False, z=True):
-    ''' '''
+    path = get_file_index().get(str(id), {}).get('zscore' if z else 'raw')
+    if not path:
+        raise FileNotFoundError(f'No matrix found for animal {id} in {FILE_INDEX_PATH}')
+
+    return path
+
+@traced
+def build_file_index(groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO']):
+    ''' Scan the group directories once and save the group, raw and z-scored .csv paths
+    of every animal in data/file_index.csv'''
+
+    global _file_index
+    rows = {}
+    for pop in groups:
+        for fname in sorted(glob.glob(f'data/{pop}/souris_*.csv')):
+            name = os.path.basename(fname)[len('souris_'):-len('.csv')]
+            if name.endswith('_zscore'):
+                animal_id, key = name[:-len('_zscore')], 'zscore'
+            else:
+                animal_id, key = name, 'raw'
+            if animal_id in rows and rows[animal_id]['group'] != pop:
+                print(f'Animal {animal_id} found in {rows[animal_id]["group"]} and {pop}, keeping {pop}')
+            rows.setdefault(animal_id, {'id': animal_id, 'group': pop, 'raw': None, 'zscore': None})
+            rows[animal_id].update({'group': pop, key: fname})
+
+    index = pd.DataFrame(list(rows.values()), columns=['id', 'group', 'raw', 'zscore'])
+    index.to_csv(FILE_INDEX_PATH, index=False)
+    _file_index = None
+    print(f'Indexed the matrices of {len(index)} animals in {FILE_INDEX_PATH}')
+
+    return index
+
+def file_index_outdated(groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO']):
+    ''' True if the file index is missing or if a group directory changed since it was built'''
+
+    if not os.path.exists(FILE_INDEX_PATH):
+        return True
+    built = os.path.getmtime(FILE_INDEX_PATH)
+
+    return any(os.path.getmtime(f'data/{pop}') > built for pop in groups if os.path.isdir(f'data/{pop}'))
+
+_file_index = None
+
+def get_file_index():
+    ''' Return the file index as a dict {id: {'group', 'raw', 'zscore'}}, building it if needed'''
+
+    global _file_index
+    if _file_index is None:
+        if not os.path.exists(FILE_INDEX_PATH):
+            build_file_index()
+        index = pd.read_csv(FILE_INDEX_PATH, dtype=str, keep_default_na=False)
+        _file_index = {row['id']: row for row in index.to_dict('records')}
+
+    return _file_index
+
+def impute_stack(stack):
+    ''' Replace the NaNs of a stack of connectivity matrices (n_animals, n_nodes, n_nodes), in place,
+    with the average of the lower triangle values of their matrix. The diagonal of the matrices
+    that had NaNs is set back to 1.'''
+
+    has_nan = np.isnan(stack).any(axis=(1, 2)) # only the matrices with NaNs are imputed
+    if not has_nan.any():
+        return stack
+    mean_vals = np.nanmean(mat2vec(stack[has_nan]), axis=1) # lower triangle values (not counting the diagonal)
+    sub = stack[has_nan]
+    nans = np.isnan(sub)
+    sub[nans] = np.broadcast_to(mean_vals[:, None, None], sub.shape)[nans] # replace NaNs with the average
+    diag = np.arange(stack.shape[-1])
+    sub[:, diag, diag] = 1 # set diagonal values to 1 (not to the average)
+    stack[has_nan] = sub
+
+    return stack
+
+def zscore_stack(stack):
+    ''' Z-scores a stack of connectivity matrices (n_animals, n_nodes, n_nodes) at once, each
+    matrix with the mean and standard deviation of its own lower triangle values (NaNs ignored).
+    Returns the z-scored stack, with the diagonal set to 1.'''
+
+    # exctract lower triangle values (because symetric matrix -> redundant values + diagonal 
+    # doesn't reflect actual connectivity)
+    tril = mat2vec(stack)
+    z = (tril - np.nanmean(tril, axis=1, keepdims=True)) / np.nanstd(tril, axis=1, keepdims=True)
+    # convert back to full matrices
+    zscored = vec2mat(z)
+
+    return zscored
+
+@traced
+def load_stacks(ids, mats={}):
+    ''' Load the raw and z-scored .csv matrices of some animals, with NaNs imputed, 
+    as two arrays of shape (n_animals, n_nodes, n_nodes). Matrices already in memory
+    ({id: (raw, zscored)}, see ingest()) are not read again.'''
+
+    def load(id, z):
+        if str(id) in mats:
+            return mats[str(id)][int(z)]
+        return get_single_mat(id, z=z)
+
+    raw = impute_stack(np.stack([load(id, z=False) for id in ids]).astype(float))
+    zscored = impute_stack(np.stack([load(id, z=True) for id in ids]).astype(float))
+
+    return raw, zscored
+
+
+class Cohort:
+    ''' All the connectivity matrices of the cohort, loaded once and stacked.
+
+    The animals are sorted by group, and females first within each group, so that every
+    group and every group of females is a contiguous block. Selections are then served as
+    views of the stacked arrays, without copying.
+
+    Attributes
+    ----------
+    meta : pd.DataFrame
+        The id, group, sex and average connectivity of each animal, in the order of the stacks.
+    raw : np.ndarray
+        The raw matrices, shape (n_animals, n_nodes, n_nodes). NaNs are imputed.
+    zscored : np.ndarray
+        The z-scored matrices, same shape as raw. NaNs are imputed.
+    '''
+
+    def __init__(self, meta, raw, zscored):
+
+        meta = meta.reset_index(drop=True)
+        order = (meta.assign(_not_f=meta['sex'] != 'f')
+                 .sort_values(['group', '_not_f'], kind='stable').index.values)
+        if np.array_equal(order, np.arange(len(meta))):
+            # already sorted (e.g. loaded from the store), keep the (memory-mapped) arrays as they are
+            self.meta = meta
+            self.raw = raw
+            self.zscored = zscored
+        else:
+            self.meta = meta.loc[order].reset_index(drop=True)
+            self.raw = raw[order]
+            self.zscored = zscored[order]
+
+        self._slices = {}
+        is_female = (self.meta['sex'] == 'f').values
+        for pop, rows in self.meta.groupby('group').indices.items():
+            start, stop = rows[0], rows[-1] + 1
+            self._slices[(pop, False)] = slice(start, stop)
+            self._slices[(pop, True)] = slice(start, start + np.sum(is_female[start:stop]))
+
+    @classmethod
+    @traced
+    def from_csv(cls, desc_path='data/all_df.csv'):
+        ''' Load the cohort described in all_df.csv from the .csv matrices of the animals'''
+
+        meta = pd.read_csv(desc_path)
+        raw, zscored = load_stacks(meta['id'])
+        print(f'{len(meta)} animals were loaded in the cohort')
+
+        return cls(meta, raw, zscored)
+
+    @classmethod
+    @traced
+    def from_store(cls, store_path=STORE_PATH, index_path=STORE_INDEX_PATH):
+        ''' Open the cohort from the binary store written by cohort_store(). The matrices are 
+        memory-mapped, only the parts that are actually used are read from disk.'''
+
+        meta = pd.read_csv(index_path)
+        stacks = np.load(store_path, mmap_mode='r')
+
+        return cls(meta, stacks[0], stacks[1])
+
+    def save(self, store_path=STORE_PATH, index_path=STORE_INDEX_PATH):
+        ''' Write the cohort to the binary store: one .npy file of shape (2, n_animals, n_nodes, n_nodes)
+        holding the raw (0) and z-scored (1) matrices, and a .csv index of the animals (same order).'''
+
+        tmp_path = store_path + '.tmp.npy'
+        np.save(tmp_path, np.stack((self.raw, self.zscored)))
+        os.replace(tmp_path, store_path)
+        self.meta.to_csv(index_path, index=False)
+
+    @property
+    def n_nodes(self):
+        return self.raw.shape[-1]
+
+    def select(self, pop, females=False):
+        ''' Slice of the animals of a group (only the females if females=True)'''
+
+        return self._slices.get((pop, females), slice(0, 0))
+
+    def get(self, pop, females=False, z=False):
+        ''' View of the matrices of a group, shape (n_animals, n_nodes, n_nodes)
+
+        Parameters
+        ----------
+        pop : str
+            The name of the group
+        females : bool
+            If True, only the matrices of female mice. Default is False.
+        z : bool
+            If True, the z-scored matrices. Default is False.
+        '''
+
+        stack = self.zscored if z else self.raw
+
+        return stack[self.select(pop, females=females)]
+
+    def ids(self, pop, females=False):
+        ''' Ids of the animals of a group'''
+
+        return self.meta['id'].values[self.select(pop, females=females)]
+
+
+_cohort = None
+
+def get_cohort(reload=False):
+    ''' Return the cohort, loading it on the first call (or if reload=True). Uses the binary
+    store when it is up to date, otherwise parses the .csv files.'''
+
+    global _cohort
+    if _cohort is None or reload:
+        if store_outdated():
+            _cohort = Cohort.from_csv()
+        else:
+            _cohort = Cohort.from_store()
+
+    return _cohort
+
+def store_outdated():
+    ''' True if the binary cohort store is missing or older than data/all_df.csv'''
+
+    if not (os.path.exists(STORE_PATH) and os.path.exists(STORE_INDEX_PATH)):
+        return True
+    if os.path.exists('data/all_df.csv'):
+        return os.path.getmtime(STORE_PATH) < os.path.getmtime('data/all_df.csv')
+    return False
+
+@traced
+def cohort_store(ids=None, mats={}):
+    ''' Gathers the raw and z-scored matrices of all the animals in one binary file
+    (data/cohort.npy) with its index (data/cohort_index.csv), for memory-mapped loading.
+    If ids is given and the store exists, only the matrices of these animals are (re)loaded
+    from the .csv files (or from mats), the others are taken from the current store.'''
 
-    mat_list = get_grp_mat(pop, females=females, z=z)
-    stack = np.stack((mat_list), axis=-1)
+    if ids is None or not os.path.exists(STORE_PATH):
+        cohort = Cohort.from_csv()
+    else:
+        ids = [str(id) for id in ids]
+        desc = pd.read_csv('data/all_df.csv')
+        old = Cohort.from_store()
+        old_ids = old.meta['id'].astype(str)
+        keep = (~old_ids.isin(ids) & old_ids.isin(desc['id'].astype(str))).values
+        new_meta = desc[desc['id'].astype(str).isin(ids)]
+        raw, zscored = old.raw[keep], old.zscored[keep]
+        if len(new_meta) > 0:
+            new_raw, new_zscored = load_stacks(new_meta['id'], mats=mats)
+            raw, zscored = np.concatenate((raw, new_raw)), np.concatenate((zscored, new_zscored))
+        # take the metadata from all_df.csv, where the rows of the updated animals changed
+        meta = pd.concat((old.meta[keep], new_meta)).reset_index(drop=True)
+        meta = meta[['id']].merge(desc, on='id', how='left')
+        cohort = Cohort(meta, raw, zscored)
+        n_removed = int(np.sum(~old_ids.isin(desc['id'].astype(str))))
+        print(f'{len(new_meta)} animals were added or updated in the cohort, {n_removed} removed')
+    cohort.save()
+    print(f'Cohort store written to {STORE_PATH}')
+
+    return None
+
+def get_av_grp_mat(pop, females=False, z=True):
+    ''' Average matrix of a group'''
 
-    return np.mean(stack, axis=-1)
+    return np.mean(get_cohort().get(pop, females=females, z=z), axis=0)
 
 def get_grp_mat(pop, females=False, z=False):
     ''' Load all the matrices in a group and return them as a list of numpy arrays
@@ -92,37 +477,17 @@ def get_grp_mat(pop, females=False, z=False):
     Returns
     -------
     mat_list : list
+        Views of the matrices held by the cohort (see get_cohort)
     '''
 
-    mat_list = []
-    
-    desc = pd.read_csv('data/all_df.csv')
-    if females:
-        mask = (desc['group']==pop) & (desc['sex']=='f')
-    else:
-        mask = desc['group']==pop
-    ids = desc[mask]['id']
-    for id in ids:
-        if z:
-            path = glob.glob(f'data/*/souris_{id}_zscore.csv')[0]
-        else:
-            path = glob.glob(f'data/*/souris_{id}.csv')[0]
-        data = pd.read_csv(path, index_col=0)
-        arr = data.values # extract values
-        if np.isnan(np.min(arr)): # if NaNs in data, replace with average
-            tril_indices = np.tril_indices(arr.shape[0], k=-1) # extract lower triangle values (not counting the diagonal)
-            tril = arr[tril_indices]
-            mean_val = np.nanmean(tril) # calculate the average of the lower triangle values
-            arr[np.isnan(arr)] = mean_val # replace NaNs with the average
-            np.fill_diagonal(arr, 1) # set diagonal values to 1 (not to the average)
-        mat_list.append(arr)
+    mat_list = list(get_cohort().get(pop, females=females, z=z))
 
     print(f'{len(mat_list)} connectivity matrices were successfully loaded')
 
     return mat_list
 
 def get_ttest_inputs(pop1, pop2, females=False):
-    ''' Gets the input for the ttest function. Takes 2 lists of matrices, and for each matrix, 
+    ''' Gets the input for the ttest function. Takes 2 groups of matrices, and for each matrix, 
     extract the lower triangle values. Stack them in a 2D array.
     Returns two 2D arrays.
     
@@ -142,36 +507,24 @@ def get_ttest_inputs(pop1, pop2, females=False):
     x2 : np.ndarray
         A 2D array of the matrices of the second group, shape (n_samples, n_edges x n_edges / 2)
     '''
-    mat_list1 = get_grp_mat(pop1, females=females, z=True)
-    mat_list2 = get_grp_mat(pop2, females=females, z=True)
-
-    n_sample1 = len(mat_list1)
-    n_sample2 = len(mat_list2)
-    n_edges = mat_list1[0].shape[0]
-
-    assert n_edges == mat_list2[0].shape[0], "Matrices have different shapes"
+    cohort = get_cohort()
 
-    tril_indices = np.tril_indices(n_edges, k=-1) # indices of the lower triangle (unique edges)
-    n_datapoints = len(tril_indices[0]) # number of unique edges (not counting the diagonal)
-
-    x1 = np.zeros((n_sample1, n_datapoints)) # initialize the result arrays
-    for i, matrix in enumerate(mat_list1): 
-        x1[i] = matrix[tril_indices] # fill the result array with the lower triangle values
-    x2 = np.zeros((n_sample2, n_datapoints))
-    for i, matrix in enumerate(mat_list2):
-        x2[i] = matrix[tril_indices]
+    # lower triangle values (unique edges)
+    x1 = mat2vec(cohort.get(pop1, females=females, z=True))
+    x2 = mat2vec(cohort.get(pop2, females=females, z=True))
 
     return x1, x2
 
-def back2mat(data, n_edges=26):
+def back2mat(data, n_edges=None):
     ''' Convert a 1D array of the lower triangle values of a matrix to a full matrix
 
     Parameters
     ----------
     data : np.ndarray
         A 1D array of the lower triangle values of a matrix
-    n_edges : int
-        The number of edges of the matrix
+    n_edges : int | None
+        The number of nodes (rows) of the matrix. Default is None, the number of nodes
+        is inferred from the length of data.
 
     Returns
     -------
@@ -179,13 +532,11 @@ def back2mat(data, n_edges=26):
         A 2D array of the full matrix
     '''
 
-    tril_indices = np.tril_indices(n_edges, k=-1)
-    mat = np.zeros((n_edges, n_edges))
-    mat[tril_indices] = data
-    mat = mat + mat.T
-    np.fill_diagonal(mat, 1)
+    data = np.asarray(data)
+    if n_edges is not None and n_nodes(len(data)) != n_edges:
+        raise ValueError(f'{len(data)} values are not the edges of a matrix with {n_edges} nodes')
 
-    return mat
+    return vec2mat(data)
 
 def get_nbs_inputs(pop1, pop2, females=False):
     ''' Get the input for the NBS function
@@ -207,11 +558,12 @@ def get_nbs_inputs(pop1, pop2, females=False):
         A 1D array of the group labels
     '''
 
-    mat_list1 = get_grp_mat(pop1, females=females, z=True)
-    mat_list2 = get_grp_mat(pop2, females=females, z=True)
-    npop1 = len(mat_list1)
-    npop2 = len(mat_list2)
-    stack = np.stack((mat_list1 + mat_list2), axis=-1)
+    cohort = get_cohort()
+    stack1 = cohort.get(pop1, females=females, z=True)
+    stack2 = cohort.get(pop2, females=females, z=True)
+    npop1 = len(stack1)
+    npop2 = len(stack2)
+    stack = np.concatenate((stack1, stack2)).transpose(1, 2, 0)
     y_vec = np.zeros((npop1 + npop2,))  
     y_vec[:npop1] = 1
     y_vec[npop1:] = 2
@@ -219,26 +571,32 @@ def get_nbs_inputs(pop1, pop2, females=False):
     return stack, y_vec, npop1, npop2
 
 
-def all_df():
+@traced
+def all_df(ids=None, mats={}):
     ''' Creates a df with average connectivty value, the id,
-    the sex and the group for each animal'''
+    the sex and the group for each animal. If ids is given, only the rows of these
+    animals are (re)computed and updated in the existing data/all_df.csv. Matrices already
+    in memory ({id: (raw, zscored)}, see ingest()) are not read again.'''
 
-    desc = pd.read_excel('data/code_animaux.xlsx')
+    desc = pd.read_excel(DESC_PATH)
     new_rows = []
     no_data = []
+    if ids is not None and os.path.exists('data/all_df.csv'):
+        ids = [str(id) for id in ids]
+        old = pd.read_csv('data/all_df.csv')
+        old = old[~old['id'].astype(str).isin(ids)]
+    else:
+        ids, old = None, None
     for row in desc.iterrows():
         grp, sex, id = row[1]
-        if grp == 'C57BL/6J':
-            grp = 'WT'
-        elif grp == '3xTg-AD':
-            grp = '3xTgAD'
-        elif grp == 'Tspo KO':
-            grp = 'TSPO_KO'
-        elif grp == '3xTg-AD-TSPO':
-            grp = '3xTgAD_TSPO_KO'
+        if ids is not None and str(id) not in ids:
+            if (old['id'].astype(str) == str(id)).any():
+                new_rows.append(old[old['id'].astype(str) == str(id)])
+            continue
+        grp = GROUP_NAMES.get(grp, grp)
         print(f'Processing {id}')
         try:
-            val = np.nanmean(get_single_mat(id))
+            val = np.nanmean(mats[str(id)][0] if str(id) in mats else get_single_mat(id))
             new_row = pd.DataFrame({'id': [id], 'group': [grp], 'sex':[sex], 'average_connectivity': [val]})
             new_rows.append(new_row)
         except:
@@ -247,46 +605,112 @@ def all_df():
 
     df = pd.concat(new_rows)
     df.to_csv('data/all_df.csv', index=False)
-    print('Dataframe created')
+    print('Dataframe created' if ids is None else f'Dataframe updated for {len(ids)} animals')
     print(f'Could not process {len(no_data)} animals: {no_data}')
 
     return None
 
-def zscore_mat(groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO']):
-    ''' Z-scores the connectivity matrices of each animal. Saves as souris_id_zscore.csv'''
-
-    for pop in groups:
-        path_list = glob.glob(f'data/{pop}/*.csv')
-        for fname in path_list:
-            if 'zscore' in fname:
-                continue
-            data = pd.read_csv(fname, index_col=0)
-            mat = data.values
-            # exctract lower triangle values (because symetric matrix -> redundant values + diagonal 
-            # doesn't reflect actual connectivity)
-            tril_indices = np.tril_indices(mat.shape[0], k=-1)
-            tril = mat[tril_indices]
-            z = (tril - np.nanmean(tril)) / np.nanstd(tril)
-            # convert back to full matrix
-            z = back2mat(z, n_edges=mat.shape[0])
-            animal_id = fname.split('souris_')[1].split('.csv')[0]
-            new_fname = f'data/{pop}/souris_{animal_id}_zscore.csv'
-            pd.DataFrame(z, columns=data.columns, index=data.index).to_csv(new_fname, index=True)    
+def desc_changed_ids():
+    ''' Ids of the animals of code_animaux.xlsx that are missing from data/all_df.csv or whose
+    group or sex differ from it, and of the animals of data/all_df.csv that were removed from
+    code_animaux.xlsx'''
+
+    desc = pd.read_excel(DESC_PATH)
+    desc.columns = ['group', 'sex', 'id']
+    desc['group'] = desc['group'].map(lambda grp: GROUP_NAMES.get(grp, grp))
+    desc['id'] = desc['id'].astype(str)
+    df = pd.read_csv('data/all_df.csv', dtype={'id': str})
+    merged = desc.merge(df, on='id', how='outer', suffixes=('', '_df'))
+    changed = (merged['group'] != merged['group_df']) | (merged['sex'] != merged['sex_df'])
+
+    return list(merged['id'][changed])
+
+@traced
+def zscore_mat(groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO'], files=None):
+    ''' Z-scores the connectivity matrices of each animal. Saves as souris_id_zscore.csv
+    If files (list of (group, .csv path)) is given, only these matrices are z-scored.'''
+
+    if files is None:
+        files = [(pop, fname) for pop in groups for fname in glob.glob(f'data/{pop}/*.csv')
+                 if 'zscore' not in fname]
+    frames = [pd.read_csv(fname, index_col=0) for _, fname in files]
+    if len(frames) == 0:
+        return None
+    zscored = zscore_stack(np.stack([data.values for data in frames]))
+    for (pop, fname), data, z in zip(files, frames, zscored):
+        animal_id = fname.split('souris_')[1].split('.csv')[0]
+        new_fname = f'data/{pop}/souris_{animal_id}_zscore.csv'
+        pd.DataFrame(z, columns=data.columns, index=data.index).to_csv(new_fname, index=True)    
 
     return None
 
-def txt_csv(groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO']):
+@traced
+def txt_csv(groups=['WT', '3xTgAD', 'TSPO_KO', '3xTgAD_TSPO_KO'], files=None):
     ''' Convert all the txt files in a group to csv files.
     Only keeps the id in the filename for easier access.
+    If files (list of (group, .txt path)) is given, only these files are converted.
     '''
 
-    for pop in groups:
-        path_list = glob.glob(f'data/{pop}/*.txt')
-        for fname in path_list:
-            data = pd.read_csv(fname, sep=r'\;', header=0, engine='python', index_col=0)
-            animal_id = fname.split('Souris')[1].split('_')[1]
-            new_fname = f'data/{pop}/souris_{animal_id}.csv'
-            data.to_csv(new_fname, index=True)
-            print(f'{fname} was converted to {new_fname}')
-
-    return None
\ No newline at end of file
+    if files is None:
+        files = [(pop, fname) for pop in groups for fname in glob.glob(f'data/{pop}/*.txt')]
+    for pop, fname in files:
+        data = read_txt(fname)
+        animal_id = txt_animal_id(fname)
+        new_fname = f'data/{pop}/souris_{animal_id}.csv'
+        data.to_csv(new_fname, index=True)
+        print(f'{fname} was converted to {new_fname}')
+
+    return None
+
+def read_txt(fname):
+    ''' Parse a semicolon-separated connectivity matrix with the C parser'''
+
+    return pd.read_csv(fname, sep=';', header=0, index_col=0, engine='c')
+
+def _ingest_file(pop, fname):
+    ''' Convert the .txt matrix of one animal, see ingest()'''
+
+    data = read_txt(fname)
+    animal_id = txt_animal_id(fname)
+    data.to_csv(f'data/{pop}/souris_{animal_id}.csv', index=True)
+
+    return animal_id, data.values.astype(float), list(data.columns)
+
+def _write_mat(fname, mat, labels):
+    pd.DataFrame(mat, columns=labels, index=labels).to_csv(fname, index=True)
+
+@traced
+def ingest(files, n_jobs=-1):
+    ''' Convert .txt matrices to souris_id.csv and z-score them to souris_id_zscore.csv, each
+    file being parsed once. Files are parsed and written on n_jobs processes, the z-scoring 
+    is done for all the matrices at once.
+
+    Parameters
+    ----------
+    files : list of tuple
+        The (group, .txt path) of the matrices to ingest
+    n_jobs : int
+        Number of processes, -1 for all the CPUs. Default is -1.
+
+    Returns
+    -------
+    mats : dict
+        {id: (raw, zscored)} matrices of the ingested animals
+    '''
+
+    parsed = list(map_chunks(_ingest_file, (), files, n_jobs=n_jobs))
+    if len(parsed) == 0:
+        return {}
+    zscored = zscore_stack(np.stack([raw for _, raw, _ in parsed]))
+
+    writes = [(f'data/{pop}/souris_{animal_id}_zscore.csv', z, labels)
+              for (pop, _), (animal_id, _, labels), z in zip(files, parsed, zscored)]
+    for _ in map_chunks(_write_mat, (), writes, n_jobs=n_jobs):
+        pass
+
+    mats = {}
+    for (_, fname), (animal_id, raw, _), z in zip(files, parsed, zscored):
+        mats[animal_id] = (raw, z)
+        print(f'{fname} was converted and z-scored')
+
+    return mats
@@ -0,0 +1,240 @@
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import inspect
+import resource
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from utils.params import trace
+
+TRACE_DIR = 'derivative/trace'
+# set to 1 to trace a run without changing utils/params.py
+TRACE_ENV = 'MCONN_TRACE'
+
+class Tracer:
+    ''' Records the spans of a run (a script): for each one its wall time, CPU time (of this
+    process and of the worker processes it waited for), peak RSS, bytes read and written
+    and counters such as the number of permutations.
+
+    Only the process that started the trace records spans, the worker processes of
+    map_chunks are accounted for in the CPU time of the span that ran them. The bytes read
+    and written are those of /proc/self/io (None where it does not exist, e.g. macOS), the
+    peak RSS is the high-water mark of the process (or of its largest worker) at the end of
+    the span.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.date = datetime.now()
+        self.events = []
+        self._stack = []
+
+    @staticmethod
+    def _sample():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in kB on Linux and in bytes on macOS
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        sample = {'wall': time.perf_counter(),
+                  'cpu': time.process_time() + children.ru_utime + children.ru_stime,
+                  'rss': max(own.ru_maxrss, children.ru_maxrss) * rss_unit,
+                  'read': None, 'written': None}
+        try:
+            with open('/proc/self/io') as f:
+                io = dict(line.split(':') for line in f)
+            sample['read'], sample['written'] = int(io['rchar']), int(io['wchar'])
+        except (OSError, KeyError, ValueError):
+            pass
+
+        return sample
+
+    def begin(self, name, args):
+        self._stack.append((name, args, {}, self._sample()))
+
+    def count(self, key, n):
+        if self._stack:
+            counters = self._stack[-1][2]
+            counters[key] = counters.get(key, 0) + n
+
+    def end(self):
+        name, args, counters, before = self._stack.pop()
+        after = self._sample()
+        event = {'name': name, 'args': args, 'depth': len(self._stack),
+                 'start_s': before['wall'] - self.start,
+                 'wall_s': after['wall'] - before['wall'],
+                 'cpu_s': after['cpu'] - before['cpu'],
+                 'peak_rss_mb': after['rss'] / 2**20,
+                 'read_mb': None, 'written_mb': None}
+        if before['read'] is not None and after['read'] is not None:
+            event['read_mb'] = (after['read'] - before['read']) / 2**20
+            event['written_mb'] = (after['written'] - before['written']) / 2**20
+        event.update(counters)
+        if 'permutations' in counters:
+            event['permutations_per_s'] = counters['permutations'] / max(event['wall_s'], 1e-9)
+        self.events.append(event)
+
+    def chrome_trace(self):
+        ''' The spans in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)'''
+
+        tid = threading.get_ident()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                   'args': {'name': self.name}}]
+        for event in self.events:
+            args = {key: value for key, value in event.items() if key not in ('name', 'start_s', 'wall_s', 'depth')}
+            args.update(args.pop('args'))
+            events.append({'name': event['name'], 'cat': self.name, 'ph': 'X', 'pid': self.pid, 'tid': tid,
+                           'ts': event['start_s'] * 1e6, 'dur': event['wall_s'] * 1e6, 'args': args})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        ''' One row per span name and arguments (e.g. per comparison): number of calls and
+        totals of the measures, sorted by decreasing wall time'''
+
+        rows = {}
+        for event in self.events:
+            label = ', '.join(f'{key}={value}' for key, value in event['args'].items())
+            row = rows.setdefault((event['name'], label), {
+                'span': event['name'], 'args': label, 'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                'peak_rss_mb': 0., 'read_mb': None, 'written_mb': None, 'permutations': None})
+            row['calls'] += 1
+            row['wall_s'] += event['wall_s']
+            row['cpu_s'] += event['cpu_s']
+            row['peak_rss_mb'] = max(row['peak_rss_mb'], event['peak_rss_mb'])
+            for key in ('read_mb', 'written_mb', 'permutations'):
+                if event.get(key) is not None:
+                    row[key] = (row[key] or 0) + event[key]
+        for row in rows.values():
+            row['permutations_per_s'] = None
+            if row['permutations'] is not None:
+                row['permutations_per_s'] = row['permutations'] / max(row['wall_s'], 1e-9)
+
+        return sorted(rows.values(), key=lambda row: -row['wall_s'])
+
+    def write(self, outdir=TRACE_DIR):
+        ''' Writes the Chrome trace (.json) and the summary table (_summary.csv) of the run,
+        and prints the summary'''
+
+        os.makedirs(outdir, exist_ok=True)
+        fbase = os.path.join(outdir, f'{self.name}_{self.date:%Y%m%d-%H%M%S}')
+        with open(f'{fbase}.json', 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        summary = self.summary()
+        columns = ['span', 'args', 'calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb', 'written_mb',
+                   'permutations', 'permutations_per_s']
+        with open(f'{fbase}_summary.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(summary)
+
+        print(f'--- trace of {self.name}: {fbase}.json ---')
+        print(f'{"span":<60} {"calls":>5} {"wall s":>9} {"cpu s":>9} {"rss MB":>8} {"read MB":>8} '
+              f'{"write MB":>8} {"perm/s":>10}')
+        for row in summary:
+            span = row['span'] + (f' ({row["args"]})' if row['args'] else '')
+            print(f'{span[:60]:<60} {row["calls"]:>5} {row["wall_s"]:9.3f} {row["cpu_s"]:9.3f} '
+                  f'{row["peak_rss_mb"]:8.1f} {_cell(row["read_mb"], 8, 1)} {_cell(row["written_mb"], 8, 1)} '
+                  f'{_cell(row["permutations_per_s"], 10, 0)}')
+
+
+def _cell(value, width, precision):
+    if value is None:
+        return f'{"-":>{width}}'
+    return f'{value:{width}.{precision}f}'
+
+
+_tracer = None
+
+def start_trace(name, enabled=None):
+    ''' Starts tracing the run of a script if tracing is enabled (trace in utils/params.py,
+    or the MCONN_TRACE environment variable). The trace is written to derivative/trace/
+    when the script exits.
+
+    Parameters
+    ----------
+    name : str
+        Name of the run, used for the trace files
+    enabled : bool | None
+        Overrides the parameter and the environment variable
+    '''
+
+    global _tracer
+    if enabled is None:
+        enabled = trace or os.environ.get(TRACE_ENV, '') not in ('', '0')
+    if not enabled or _active():
+        return None
+    _tracer = Tracer(name)
+    atexit.register(stop_trace)
+
+    return None
+
+def stop_trace():
+    ''' Stops tracing and writes the trace, if one was started'''
+
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and tracer.events:
+        tracer.write()
+
+def _active():
+    return _tracer is not None and _tracer.pid == os.getpid()
+
+@contextmanager
+def span(name, **args):
+    ''' Records the block as a span of the trace, with some arguments (e.g. the comparison).
+    Does nothing if no trace was started.'''
+
+    if not _active():
+        yield
+        return
+    _tracer.begin(name, args)
+    try:
+        yield
+    finally:
+        _tracer.end()
+
+def count(key, n):
+    ''' Adds n to a counter of the innermost span, e.g. count('permutations', k). The
+    permutation rate of the spans is computed from the 'permutations' counter.'''
+
+    if _active():
+        _tracer.count(key, n)
+
+def _span_args(signature, args, kwargs):
+    ''' Arguments of a call worth showing in the trace: the numbers, strings and sequences
+    of them (e.g. the groups compared, only their number if the sequence is long), not the
+    arrays'''
+
+    try:
+        bound = signature.bind(*args, **kwargs)
+    except TypeError:
+        return {}
+    shown = {}
+    for key, value in bound.arguments.items():
+        if value is None or isinstance(value, (str, bool, int, float)):
+            shown[key] = value
+        elif isinstance(value, (list, tuple)) and all(isinstance(v, (str, int, float, tuple)) for v in value):
+            shown[key] = repr(value) if len(repr(value)) <= 40 else f'{len(value)} items'
+
+    return shown
+
+def traced(func):
+    ''' Decorator recording each call of func as a span, with its simple arguments'''
+
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _active():
+            return func(*args, **kwargs)
+        with span(func.__qualname__, **_span_args(signature, args, kwargs)):
+            return func(*args, **kwargs)
+
+    return wrapper